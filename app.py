@@ -1,6 +1,9 @@
+import asyncio
+import time
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel, Field, model_validator
 import pandas as pd
 import torch
 from fastapi.middleware.cors import CORSMiddleware
@@ -8,6 +11,11 @@ import os
 
 # Import the Recommender class from your src package
 from src.inference import Recommender
+from src.cache import RecommendationCache
+from src.scheduler import InferenceScheduler
+from src.registry import ModelRegistry, resolve_artifact_dir
+from src.fallback import FallbackRecommender
+from src.metrics import REGISTRY, STAGE_SECONDS, HTTP_REQUEST_SECONDS, HTTP_REQUESTS, FALLBACK_RESPONSES, PROFILER
 
 # Initialize the FastAPI app
 app = FastAPI(
@@ -26,29 +34,136 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Request metrics and sampled profiling ---
+# PROFILE_SAMPLE_RATE (0-1) profiles the model work of that fraction of requests with
+# cProfile, in the thread that does it; it can also be changed at runtime through
+# POST /admin/profiling. Sampled responses carry their profile tag's request id.
+PROFILER.sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        with PROFILER.sample_request(f"{request.method} {request.url.path}") as profile_id:
+            response = await call_next(request)
+        if profile_id is not None:
+            response.headers['X-Profile-Request-Id'] = profile_id
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template so the number of series stays bounded
+        route = request.scope.get('route')
+        path = route.path if route is not None else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method, path=path)
+        HTTP_REQUESTS.inc(method=request.method, path=path, status=str(status))
+
 # --- 2. Load the Recommender Model at Startup ---
-# This global variable will hold our recommender instance.
-recommender = None
+# Ranked song indices per (playlist_id, model version), so later pages don't recompute scores
+MAX_RECOMMENDATIONS = 500
+# Largest playlist_ids list accepted by the batch endpoint; bigger jobs are split by the caller
+BATCH_MAX_PLAYLISTS = int(os.getenv('BATCH_MAX_PLAYLISTS', '10000'))
+recommendation_cache = RecommendationCache(
+    max_entries=int(os.getenv('CACHE_MAX_ENTRIES', '10000')),
+    ttl_seconds=float(os.getenv('CACHE_TTL_SECONDS', '600'))
+)
+
+def collect_cache_metrics():
+    stats = recommendation_cache.stats()
+    lines = []
+    for name in ('hits', 'misses', 'coalesced', 'evictions'):
+        lines += [f'# TYPE recommendation_cache_{name}_total counter',
+                  f'recommendation_cache_{name}_total {stats[name]}']
+    lines += ['# TYPE recommendation_cache_entries gauge', f'recommendation_cache_entries {stats["entries"]}']
+    return lines
+
+REGISTRY.add_collector(collect_cache_metrics)
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse that records the JSON encoding time as the 'serialization' stage."""
+    def render(self, content):
+        with STAGE_SECONDS.time(stage='serialization'):
+            return super().render(content)
+
+def build_model(artifact_dir):
+    """Builds the recommender for one artifact directory and the scheduler that micro-batches requests to it."""
+    # RETRIEVAL_BACKEND=ivf serves from the approximate index built by `main.py --stage index`,
+    # int8/float16 from the quantized embeddings built by `main.py --stage quantize`
+    recommender = Recommender(
+        artifact_dir=artifact_dir,
+        retrieval=os.getenv('RETRIEVAL_BACKEND', 'exact'),
+        nprobe=int(os.getenv('IVF_NPROBE', '8')),
+        rerank_factor=int(os.getenv('RERANK_FACTOR', '4'))
+    )
+    scheduler = InferenceScheduler(
+        recommender,
+        max_batch_size=int(os.getenv('SCHEDULER_MAX_BATCH_SIZE', '64')),
+        max_wait_ms=float(os.getenv('SCHEDULER_MAX_WAIT_MS', '2')),
+        num_workers=int(os.getenv('SCHEDULER_WORKERS', '1')),
+        torch_threads=int(os.getenv('TORCH_NUM_THREADS', '0')) or None
+    )
+    return recommender, scheduler
+
+# Popularity/co-occurrence recommender used when the GNN can't answer: no model
+# loaded, a playlist the model doesn't know, or a ranking slower than
+# GNN_TIMEOUT_MS (0 disables the latency budget)
+GNN_TIMEOUT_SECONDS = float(os.getenv('GNN_TIMEOUT_MS', '0')) / 1000
+fallback_recommender = None
+
+def load_fallback(artifact_dir):
+    global fallback_recommender
+    try:
+        fallback_recommender = FallbackRecommender(artifact_dir)
+    except Exception as e:
+        print(f"WARNING: Fallback recommender not available. Error: {e}")
+
+def swap_model(handle):
+    # Cached rankings belong to the previous artifacts
+    recommendation_cache.clear()
+    load_fallback(handle.artifact_dir)
+
+# The registry holds the live model version. ARTIFACT_DIR may contain timestamped
+# version directories (as downloaded by `scripts/sync_s3.py --versioned`), in
+# which case the latest one is served; otherwise it is used as-is.
+registry = ModelRegistry(
+    root_dir=os.getenv('ARTIFACT_DIR', os.path.join(os.path.dirname(__file__), 'artifacts')),
+    factory=build_model,
+    on_swap=swap_model
+)
 
 @app.on_event("startup")
 def load_model():
     """Load the recommender model into memory when the application starts."""
-    global recommender
     try:
-        # We assume the artifacts are in the 'artifacts' directory relative to the app's location
-        artifact_path = os.path.join(os.path.dirname(__file__), 'artifacts')
-        recommender = Recommender(artifact_dir=artifact_path)
+        registry.load()
     except Exception as e:
         print(f"FATAL: Could not load recommender model. Error: {e}")
         # In a real application, you might want to prevent the app from starting
-        # if the model can't be loaded. For now, we set it to None.
-        recommender = None
+        # if the model can't be loaded. For now, requests are served by the
+        # fallback recommender (or get a 503) until a reload succeeds.
+    if fallback_recommender is None:
+        load_fallback(resolve_artifact_dir(registry.root_dir))
+
+    watch_interval = float(os.getenv('ARTIFACT_WATCH_INTERVAL_SECONDS', '0'))
+    if watch_interval > 0:
+        registry.start_watcher(watch_interval)
+
+@app.on_event("shutdown")
+def release_model():
+    registry.close()
 
 # --- 3. Define Request and Response Data Models ---
 class RecommendationRequest(BaseModel):
     playlist_id: int
-    page: int = 1
-    page_size: int = 10
+    page: int = Field(1, ge=1)
+    page_size: int = Field(10, ge=1, le=MAX_RECOMMENDATIONS)
+
+    @model_validator(mode='after')
+    def check_within_ranking(self):
+        # Only the top MAX_RECOMMENDATIONS songs are ranked and cached per playlist
+        if self.page * self.page_size > MAX_RECOMMENDATIONS:
+            raise ValueError(f"page * page_size must be at most {MAX_RECOMMENDATIONS}.")
+        return self
 
 class Song(BaseModel):
     track_name_x: str
@@ -57,6 +172,28 @@ class Song(BaseModel):
 class RecommendationResponse(BaseModel):
     recommendations: list[Song]
     hasMore: bool
+    source: str = "gnn"  # "fallback" when served from popularity/co-occurrence
+
+class BatchRecommendationRequest(BaseModel):
+    playlist_ids: list[int] = Field(max_length=BATCH_MAX_PLAYLISTS)
+    num_recommendations: int = Field(10, ge=1, le=MAX_RECOMMENDATIONS)
+
+class PlaylistRecommendations(BaseModel):
+    playlist_id: int
+    recommendations: list[Song] = []
+    error: str | None = None
+    source: str | None = None
+
+class BatchRecommendationResponse(BaseModel):
+    results: list[PlaylistRecommendations]
+
+class SeedTracksRequest(BaseModel):
+    track_uris: list[str]
+    num_recommendations: int = Field(10, ge=1, le=MAX_RECOMMENDATIONS)
+
+class SeedTracksResponse(BaseModel):
+    recommendations: list[Song]
+    source: str = "gnn"
 
 # --- 4. Create API Endpoints ---
 @app.get("/")
@@ -64,43 +201,198 @@ def read_root():
     """A simple root endpoint to confirm the API is running."""
     return {"message": "Welcome to the Music Recommender API. Navigate to /docs for the interactive API documentation."}
 
-@app.post("/recommendations/", response_model=RecommendationResponse)
-def get_recommendations(request: RecommendationRequest):
+@app.get("/cache/stats")
+def get_cache_stats():
+    """Returns hit/miss counters of the recommendation cache."""
+    return recommendation_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Exposes startup, per-stage and HTTP latency metrics in the Prometheus text format."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+async def rank_with_fallback(model, playlist_id, num_recommendations, rank):
+    """Ranks songs with ``rank()`` (a coroutine function on the GNN path), falling back
+    to the popularity/co-occurrence recommender when the GNN can't answer in time.
+
+    Returns (ranked song indices, recommender holding their metadata, source),
+    where source is "gnn" or "fallback". Without a fallback, ranked is None and
+    source is the reason: "model_unavailable", "unknown_playlist" or "timeout".
+    """
+    reason = 'model_unavailable'
+    if model is not None:
+        try:
+            if GNN_TIMEOUT_SECONDS > 0:
+                # Shielded so a slow ranking still completes (and is cached) after the timeout
+                ranked = await asyncio.wait_for(asyncio.shield(rank()), GNN_TIMEOUT_SECONDS)
+            else:
+                ranked = await rank()
+            if ranked is not None:
+                return ranked, model.recommender, "gnn"
+            reason = 'unknown_playlist'
+        except asyncio.TimeoutError:
+            reason = 'timeout'
+
+    fallback = fallback_recommender
+    if fallback is None:
+        return None, None, reason
+    FALLBACK_RESPONSES.inc(reason=reason)
+    return fallback.rank_songs(playlist_id, num_recommendations), fallback, "fallback"
+
+@app.post("/recommendations/", response_model=RecommendationResponse, response_class=TimedJSONResponse)
+async def get_recommendations(request: RecommendationRequest):
     """
     Takes a playlist ID and returns a paginated list of song recommendations.
     """
-    if recommender is None:
-        raise HTTPException(status_code=503, detail="Model is not available. Please check server logs.")
-
-    try:
-        # --- Get All Possible Recommendations ---
-        # The underlying recommender logic calculates scores for all songs.
-        # We'll get all of them and then slice for pagination.
-        all_recs_df = recommender.get_recommendations(
-            playlist_id=request.playlist_id,
-            num_recommendations=500  # Fetch a large number to paginate from
-        )
+    # Holding the handle keeps this model version alive even if a reload swaps it out meanwhile
+    with registry.acquire() as model:
+        try:
+            # --- Get All Possible Recommendations ---
+            # The full ranking is computed once per playlist and model version and
+            # cached, so fetching later pages only slices it. Misses are scored by
+            # the scheduler together with other concurrent requests.
+            ranked, source, label = await rank_with_fallback(
+                model, request.playlist_id, MAX_RECOMMENDATIONS,
+                lambda: recommendation_cache.aget_or_compute(
+                    (request.playlist_id, model.recommender.version),
+                    lambda: model.scheduler.rank_songs(request.playlist_id, num_recommendations=MAX_RECOMMENDATIONS)
+                )
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"An internal error occurred: {str(e)}")
 
-        if "error" in all_recs_df:
-             raise HTTPException(status_code=404, detail=all_recs_df["error"])
+        if ranked is None:
+            if label == 'model_unavailable':
+                raise HTTPException(status_code=503, detail="Model is not available. Please check server logs.")
+            if label == 'timeout':
+                raise HTTPException(status_code=504, detail="Recommendations took too long to compute.")
+            raise HTTPException(status_code=404, detail=f"Playlist ID {request.playlist_id} not found in the dataset.")
 
         # --- Paginate the Results ---
         start_index = (request.page - 1) * request.page_size
         end_index = start_index + request.page_size
         
-        paginated_recs = all_recs_df.iloc[start_index:end_index]
+        paginated_recs = source.get_song_metadata(ranked[start_index:end_index])
         
         # Determine if there are more pages
-        has_more = end_index < len(all_recs_df)
+        has_more = end_index < len(ranked)
 
-        return {
-            "recommendations": paginated_recs.to_dict('records'),
-            "hasMore": has_more
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An internal error occurred: {str(e)}")
+        # The JSON encoding itself is timed as 'serialization' by TimedJSONResponse
+        with STAGE_SECONDS.time(stage='response_build'):
+            return {
+                "recommendations": paginated_recs.to_dict('records'),
+                "hasMore": has_more,
+                "source": label
+            }
+
+@app.post("/recommendations/batch/", response_model=BatchRecommendationResponse, response_class=TimedJSONResponse)
+async def get_recommendations_batch(request: BatchRecommendationRequest):
+    """
+    Takes a list of playlist IDs (at most BATCH_MAX_PLAYLISTS) and returns recommendations
+    for each, in input order. Unknown playlists are served by the fallback recommender,
+    or get an error entry when there is none, instead of failing the whole batch.
+    """
+    with registry.acquire() as model:
+        if model is None and fallback_recommender is None:
+            raise HTTPException(status_code=503, detail="Model is not available. Please check server logs.")
+
+        try:
+            rankings = [None] * len(request.playlist_ids)
+            if model is not None:
+                # One scheduler job, scored with the recommender's blocked matrix-matrix top-k
+                rankings = await model.scheduler.rank_songs_batch(
+                    request.playlist_ids, num_recommendations=request.num_recommendations
+                )
+
+            results = []
+            for playlist_id, ranked in zip(request.playlist_ids, rankings):
+                source, label = (model.recommender if model is not None else None), "gnn"
+                if ranked is None:
+                    fallback = fallback_recommender
+                    if fallback is None:
+                        results.append({"playlist_id": playlist_id,
+                                        "error": f"Playlist ID {playlist_id} not found in the dataset."})
+                        continue
+                    FALLBACK_RESPONSES.inc(reason='model_unavailable' if model is None else 'unknown_playlist')
+                    ranked, source, label = fallback.rank_songs(playlist_id, request.num_recommendations), fallback, "fallback"
+                recs = source.get_song_metadata(ranked)
+                results.append({"playlist_id": playlist_id, "recommendations": recs.to_dict('records'),
+                                "source": label})
+            return {"results": results}
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"An internal error occurred: {str(e)}")
+
+@app.post("/recommendations/from-tracks/", response_model=SeedTracksResponse, response_class=TimedJSONResponse)
+def get_recommendations_from_tracks(request: SeedTracksRequest):
+    """
+    Takes the track URIs of a playlist that is not in the dataset (e.g. one created
+    after training) and returns recommendations computed from those tracks.
+    """
+    with registry.acquire() as model:
+        recs = {"error": "Model is not available. Please check server logs."}
+        if model is not None:
+            try:
+                # Runs in a threadpool thread, not through the scheduler, so it is profiled here
+                with PROFILER.profile():
+                    recs = model.recommender.get_recommendations_for_tracks(
+                        track_uris=request.track_uris,
+                        num_recommendations=request.num_recommendations
+                    )
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"An internal error occurred: {str(e)}")
+
+    if isinstance(recs, dict):
+        fallback = fallback_recommender
+        if fallback is None:
+            raise HTTPException(status_code=503 if model is None else 404, detail=recs["error"])
+        FALLBACK_RESPONSES.inc(reason='model_unavailable' if model is None else 'unknown_tracks')
+        ranked = fallback.rank_for_tracks(request.track_uris, request.num_recommendations)
+        return {"recommendations": fallback.get_song_metadata(ranked).to_dict('records'), "source": "fallback"}
+    return {"recommendations": recs.to_dict('records')}
+
+# --- 5. Admin Endpoints ---
+class ReloadRequest(BaseModel):
+    version: str | None = None  # Defaults to the latest version directory
+
+@app.get("/admin/model")
+def get_model_status():
+    """Reports which artifact version is being served and whether a reload is in progress."""
+    current = registry.current
+    return {
+        "artifact_dir": current.artifact_dir if current else None,
+        "model_version": current.recommender.version if current else None,
+        "loaded_at": current.loaded_at if current else None,
+        "loading": registry.loading,
+        "last_error": registry.last_error,
+    }
+
+@app.post("/admin/reload", status_code=202)
+def reload_model(request: ReloadRequest):
+    """
+    Builds the requested artifact version in the background and swaps it in once ready.
+    Requests keep being served by the current version in the meantime.
+    """
+    if not registry.reload_in_background(request.version):
+        raise HTTPException(status_code=409, detail="A reload is already in progress.")
+    return {"status": "reloading", "version": request.version or "latest"}
+
+class ProfilingRequest(BaseModel):
+    sample_rate: float  # Fraction of requests to profile; 0 disables
+
+@app.get("/admin/profiling")
+def get_profiles():
+    """Returns the most recent profiles of sampled requests' model work, newest last."""
+    return {"sample_rate": PROFILER.sample_rate, "profiles": list(PROFILER.profiles)}
+
+@app.post("/admin/profiling")
+def set_profiling(request: ProfilingRequest):
+    """Changes the request profiling sample rate without a restart."""
+    if not 0 <= request.sample_rate <= 1:
+        raise HTTPException(status_code=422, detail="sample_rate must be between 0 and 1.")
+    PROFILER.sample_rate = request.sample_rate
+    return {"sample_rate": PROFILER.sample_rate}
 
-# --- 5. Run the API Server ---
+# --- 6. Run the API Server ---
 if __name__ == "__main__":
     # This block allows you to run the app directly using `python app.py`
     # It will look for the uvicorn package in your virtual environment.
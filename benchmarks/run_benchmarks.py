@@ -0,0 +1,240 @@
+# benchmarks/run_benchmarks.py
+"""End-to-end serving benchmark on a synthetic MPD-shaped dataset.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.run_benchmarks --playlists 20000 --songs 100000 --output bench.json
+
+Results are written as JSON so runs before and after a change can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+from benchmarks.synthetic import generate_dataset
+from src.data_processing import create_graph_data
+from src.train import train_model
+from src.export import export_embeddings
+from src.inference import Recommender
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loads a Recommender in a fresh process and reports its load time and peak RSS. Peak RSS
+# comes from VmHWM: on Linux ru_maxrss survives fork+exec, so it would report the
+# benchmark driver's high-water mark whenever that is larger.
+COLD_START_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+from src.inference import Recommender
+recommender = Recommender(artifact_dir=sys.argv[1], mode=sys.argv[2])
+seconds = time.perf_counter() - start
+try:
+    with open('/proc/self/status') as f:
+        peak_rss_mb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 1024
+except (OSError, StopIteration):
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_rss_mb}))
+"""
+
+def _percentiles(samples_ms):
+    samples = np.asarray(samples_ms)
+    return {
+        'count': int(samples.size),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'max_ms': float(samples.max()),
+    }
+
+def _timed(label, fn, *args, **kwargs):
+    print(f"\n=== {label} ===")
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+def measure_cold_start(artifact_dir, mode):
+    """Loads the recommender in a subprocess so peak RSS reflects only the server's load."""
+    output = subprocess.run(
+        [sys.executable, '-c', COLD_START_PROBE, artifact_dir, mode],
+        cwd=REPO_ROOT, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def measure_single_query(recommender, playlist_ids, k):
+    latencies = []
+    for playlist_id in playlist_ids:
+        start = time.perf_counter()
+        recommender.get_recommendations(playlist_id, num_recommendations=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return _percentiles(latencies)
+
+def measure_batch_throughput(recommender, playlist_ids, k, batch_sizes):
+    results = {}
+    for batch_size in batch_sizes:
+        batches = [playlist_ids[i:i + batch_size] for i in range(0, len(playlist_ids), batch_size)]
+        start = time.perf_counter()
+        for batch in batches:
+            recommender.get_recommendations_batch(batch, num_recommendations=k)
+        seconds = time.perf_counter() - start
+        results[str(batch_size)] = {'playlists_per_second': len(playlist_ids) / seconds, 'seconds': seconds}
+    return results
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _post(url, payload, timeout=30):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
+
+def measure_http(artifact_dir, playlist_ids, concurrency, num_requests, page_size=10, startup_timeout=600):
+    """Starts app.py under uvicorn and drives POST /recommendations/ from ``concurrency`` threads."""
+    port = _free_port()
+    env = dict(os.environ, ARTIFACT_DIR=os.path.abspath(artifact_dir))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        cwd=REPO_ROOT, env=env
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        # --- Wait until the model is loaded ---
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            try:
+                with urllib.request.urlopen(f'{base_url}/admin/model', timeout=5) as response:
+                    if json.loads(response.read())['model_version']:
+                        break
+            except OSError:
+                pass
+            if time.monotonic() > deadline or server.poll() is not None:
+                raise RuntimeError("API server did not become ready.")
+            time.sleep(0.5)
+
+        latencies, errors = [], 0
+        lock = threading.Lock()
+        # Pages 1-3 of the same playlists, like a user scrolling, so the results cache is exercised
+        pages = np.random.default_rng(1).integers(1, 4, num_requests)
+
+        def one_request(i):
+            nonlocal errors
+            payload = {'playlist_id': int(playlist_ids[i % len(playlist_ids)]),
+                       'page': int(pages[i]), 'page_size': page_size}
+            start = time.perf_counter()
+            try:
+                _post(f'{base_url}/recommendations/', payload)
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    latencies.append(elapsed)
+            except OSError:
+                with lock:
+                    errors += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one_request, range(num_requests)))
+        seconds = time.perf_counter() - start
+
+        with urllib.request.urlopen(f'{base_url}/cache/stats', timeout=5) as response:
+            cache_stats = json.loads(response.read())
+        return {
+            'concurrency': concurrency,
+            'requests': num_requests,
+            'errors': errors,
+            'requests_per_second': num_requests / seconds,
+            'latency': _percentiles(latencies) if latencies else None,
+            'cache': cache_stats,
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recommender on a synthetic dataset.")
+    parser.add_argument('--playlists', type=int, default=10000)
+    parser.add_argument('--songs', type=int, default=50000)
+    parser.add_argument('--tracks-per-playlist', type=int, default=50)
+    parser.add_argument('--epochs', type=int, default=5, help="Training epochs (quality is irrelevant here).")
+    parser.add_argument('--work-dir', type=str, default='bench_work')
+    parser.add_argument('--output', type=str, default='bench_results.json')
+    parser.add_argument('--queries', type=int, default=500, help="Playlists used for latency/throughput.")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 128, 1024])
+    parser.add_argument('--http-concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--http-requests', type=int, default=2000)
+    parser.add_argument('--skip-http', action='store_true')
+    parser.add_argument('--reuse', action='store_true', help="Reuse data and artifacts already in --work-dir.")
+    args = parser.parse_args()
+
+    artifact_dir = os.path.join(args.work_dir, 'artifacts')
+    results = {
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cpu_count': os.cpu_count(),
+            'platform': platform.platform(),
+            'git_commit': _git_commit(),
+        },
+        'timings_seconds': {},
+    }
+
+    # --- Build the pipeline on synthetic data ---
+    if not (args.reuse and os.path.exists(os.path.join(artifact_dir, 'song_embeddings.emb'))):
+        timings = results['timings_seconds']
+        start = time.perf_counter()
+        data_dir, features_path = generate_dataset(args.work_dir, args.playlists, args.songs, args.tracks_per_playlist)
+        timings['generate'] = time.perf_counter() - start
+        timings['process'] = _timed("process", create_graph_data, data_dir, features_path, output_dir=artifact_dir,
+                                     shard_dir=os.path.join(args.work_dir, 'shards'))
+        timings['train'] = _timed("train", train_model, os.path.join(artifact_dir, 'graph_data.pt'),
+                                  epochs=args.epochs, output_dir=artifact_dir)
+        timings['export'] = _timed("export", export_embeddings, artifact_dir)
+
+    # --- Cold start ---
+    print("\n=== cold start ===")
+    results['cold_start'] = {mode: measure_cold_start(artifact_dir, mode) for mode in ('graph', 'embeddings')}
+
+    # --- In-process latency and throughput ---
+    recommender = Recommender(artifact_dir=artifact_dir)
+    rng = np.random.default_rng(0)
+    all_pids = np.asarray(recommender.playlist_mapping.keys)
+    query_pids = rng.choice(all_pids, size=min(args.queries, len(all_pids)), replace=False).tolist()
+
+    print("\n=== single query latency ===")
+    results['single_query'] = measure_single_query(recommender, query_pids, args.k)
+    print("\n=== batch throughput ===")
+    results['batch_throughput'] = measure_batch_throughput(recommender, query_pids, args.k, args.batch_sizes)
+    del recommender
+
+    # --- HTTP ---
+    if not args.skip_http:
+        results['http'] = []
+        for concurrency in args.http_concurrency:
+            print(f"\n=== HTTP, concurrency {concurrency} ===")
+            results['http'].append(measure_http(artifact_dir, query_pids, concurrency, args.http_requests))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nBenchmark results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# benchmarks/synthetic.py
+import json
+import os
+import numpy as np
+import pandas as pd
+
+BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+def _track_id(i):
+    """Deterministic 22-character base62 ID, shaped like a Spotify track ID."""
+    chars = []
+    for _ in range(22):
+        i, r = divmod(i, 62)
+        chars.append(BASE62[r])
+    return ''.join(reversed(chars))
+
+def generate_dataset(output_dir, num_playlists=10000, num_songs=50000, tracks_per_playlist=50,
+                     playlists_per_slice=1000, seed=0):
+    """Writes an MPD-shaped dataset: JSON slices under ``output_dir/data`` and a
+    track-features CSV at ``output_dir/features.csv``.
+
+    Songs are drawn with Zipf-like popularity, and playlist lengths are
+    Poisson around ``tracks_per_playlist``, so degree distributions look like
+    the real data. Returns (data_dir, features_path).
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(output_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+
+    track_ids = [_track_id(i) for i in range(num_songs)]
+    popularity = 1.0 / np.arange(1, num_songs + 1) ** 0.8
+    popularity /= popularity.sum()
+
+    # --- JSON slices ---
+    for slice_start in range(0, num_playlists, playlists_per_slice):
+        slice_end = min(slice_start + playlists_per_slice, num_playlists)
+        playlists = []
+        for pid in range(slice_start, slice_end):
+            length = int(np.clip(rng.poisson(tracks_per_playlist), 1, num_songs))
+            songs = rng.choice(num_songs, size=length, replace=False, p=popularity)
+            playlists.append({
+                'pid': pid,
+                'name': f'playlist {pid}',
+                'num_tracks': length,
+                'tracks': [{
+                    'pos': pos,
+                    'track_uri': f'spotify:track:{track_ids[song]}',
+                    'track_name': f'track {song}',
+                    'artist_name': f'artist {song % 997}',
+                    'album_name': f'album {song % 4999}',
+                } for pos, song in enumerate(songs.tolist())],
+            })
+        slice_name = f'mpd.slice.{slice_start}-{slice_end - 1}.json'
+        with open(os.path.join(data_dir, slice_name), 'w') as f:
+            json.dump({'info': {'slice': f'{slice_start}-{slice_end - 1}'}, 'playlists': playlists}, f)
+
+    # --- Track features, with the columns of the HF spotify-tracks dataset that the pipeline uses ---
+    features_path = os.path.join(output_dir, 'features.csv')
+    pd.DataFrame({
+        'track_id': track_ids,
+        'artists': [f'artist {i % 997}' for i in range(num_songs)],
+        'album_name': [f'album {i % 4999}' for i in range(num_songs)],
+        'track_name': [f'track {i}' for i in range(num_songs)],
+        'popularity': rng.integers(0, 100, num_songs),
+        'danceability': rng.random(num_songs),
+        'energy': rng.random(num_songs),
+        'loudness': rng.uniform(-40, 0, num_songs),
+        'speechiness': rng.random(num_songs),
+        'acousticness': rng.random(num_songs),
+        'instrumentalness': rng.random(num_songs),
+        'liveness': rng.random(num_songs),
+        'valence': rng.random(num_songs),
+        'tempo': rng.uniform(60, 200, num_songs),
+    }).to_csv(features_path, index=False)
+    return data_dir, features_path
@@ -1,12 +1,52 @@
 # main.py
 import argparse
-from src.data_processing import create_graph_data
+from src.data_processing import create_graph_data, update_graph_data
 from src.train import train_model
+from src.retrieval import build_ivf_index, build_quantized_index
+from src.export import export_embeddings
+from src.evaluate import evaluate_recommender
 
 def main():
     parser = argparse.ArgumentParser(description="Run the GNN music recommender pipeline.")
-    parser.add_argument('--stage', type=str, required=True, choices=['process', 'train', 'all'],
+    parser.add_argument('--stage', type=str, required=True, choices=['process', 'train', 'export', 'index', 'quantize', 'evaluate', 'all'],
                         help="Which stage of the pipeline to run.")
+    parser.add_argument('--ivf-lists', type=int, default=None,
+                        help="Number of IVF lists for --stage index (default: 4 * sqrt(#songs)).")
+    parser.add_argument('--quantize-dtype', type=str, nargs='+', default=['int8', 'float16'],
+                        choices=['int8', 'float16'], help="Quantized embedding formats built by --stage quantize.")
+    parser.add_argument('--eval-k', type=int, nargs='+', default=[10, 100],
+                        help="Cutoffs for recall@k/NDCG@k/coverage in --stage evaluate.")
+    parser.add_argument('--eval-playlists', type=int, default=None,
+                        help="Evaluate a random sample of this many playlists (default: all with enough tracks).")
+    parser.add_argument('--eval-query', type=str, default='seed', choices=['seed', 'embedding'],
+                        help="Embed evaluated playlists from their visible tracks (seed) or use the trained embedding.")
+    parser.add_argument('--eval-workers', type=int, default=1, help="Processes used by --stage evaluate.")
+    parser.add_argument('--eval-holdout', type=str, default='training', choices=['training', 'random'],
+                        help="Hide the test pairs held out in training, or random songs of the served graph (optimistic).")
+    parser.add_argument('--epochs', type=int, default=300, help="Number of training epochs.")
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help="Train with neighbour-sampled mini-batches of this many supervision edges "
+                             "(default: full-graph training).")
+    parser.add_argument('--num-neighbors', type=int, nargs='+', default=[20, 10],
+                        help="Neighbour-sampling fanout per GNN layer for mini-batch training.")
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help="DataLoader worker processes for mini-batch training.")
+    parser.add_argument('--nproc', type=int, default=1,
+                        help="Training processes; >1 trains with DistributedDataParallel on CPU (needs --batch-size).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue training from the last checkpoint in the artifacts directory.")
+    parser.add_argument('--eval-interval', type=int, default=5,
+                        help="Compute validation AUC every this many epochs.")
+    parser.add_argument('--patience', type=int, default=10,
+                        help="Stop after this many evaluations without a validation AUC improvement (0 disables).")
+    parser.add_argument('--checkpoint-interval', type=int, default=10,
+                        help="Write a training checkpoint every this many epochs.")
+    parser.add_argument('--ingest', type=str, default='stream', choices=['stream', 'pandas'],
+                        help="How --stage process reads the JSON slices.")
+    parser.add_argument('--ingest-workers', type=int, default=None,
+                        help="Processes used to parse JSON slices (default: all cores).")
+    parser.add_argument('--incremental', action='store_true',
+                        help="With --stage process, only ingest JSON slices not yet in the artifacts' manifest.")
     args = parser.parse_args()
 
     # Define paths for our new structure
@@ -15,12 +55,33 @@ def main():
     features_csv_path = "hf://datasets/maharshipandya/spotify-tracks-dataset/dataset.csv"
     graph_path = 'artifacts/graph_data.pt'
     artifacts_dir = 'artifacts'
+    shard_dir = 'work/shards'  # Ingest intermediates, kept out of the synced artifacts
 
-    if args.stage == 'process' or args.stage == 'all':
-        create_graph_data(raw_data_path, features_csv_path, output_dir=artifacts_dir)
+    if (args.stage == 'process' or args.stage == 'all') and args.incremental:
+        update_graph_data(raw_data_path, features_csv_path, output_dir=artifacts_dir,
+                          num_workers=args.ingest_workers, shard_dir=shard_dir)
+    elif args.stage == 'process' or args.stage == 'all':
+        create_graph_data(raw_data_path, features_csv_path, output_dir=artifacts_dir,
+                          ingest=args.ingest, num_workers=args.ingest_workers, shard_dir=shard_dir)
     
     if args.stage == 'train' or args.stage == 'all':
-        train_model(graph_path, output_dir=artifacts_dir)
+        train_model(graph_path, epochs=args.epochs, output_dir=artifacts_dir, batch_size=args.batch_size,
+                    num_neighbors=args.num_neighbors, num_workers=args.num_workers, nproc=args.nproc,
+                    resume=args.resume, eval_interval=args.eval_interval, patience=args.patience or None,
+                    checkpoint_interval=args.checkpoint_interval)
+
+    if args.stage == 'export' or args.stage == 'all':
+        export_embeddings(artifacts_dir)
+
+    if args.stage == 'index':
+        build_ivf_index(artifacts_dir, num_lists=args.ivf_lists)
+
+    if args.stage == 'evaluate':
+        evaluate_recommender(artifacts_dir, ks=args.eval_k, num_playlists=args.eval_playlists,
+                             query=args.eval_query, num_workers=args.eval_workers, holdout=args.eval_holdout)
+
+    if args.stage == 'quantize':
+        build_quantized_index(artifacts_dir, dtypes=args.quantize_dtype)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
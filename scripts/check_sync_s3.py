@@ -0,0 +1,94 @@
+import os
+import sys
+import filecmp
+import tempfile
+import time
+
+# Allow running as `python scripts/check_sync_s3.py` from the repository root
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import boto3
+from moto import mock_aws
+
+from sync_s3 import EXCLUDED_ARTIFACT_DIRS, LOCAL_MANIFEST_NAME, MANIFEST_NAME, get_latest_s3_version, sync_s3
+
+BUCKET = 'sync-check-bucket'
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def same_tree(expected_dir, actual_dir, exclude_dirs=()):
+    """True if every file of ``expected_dir`` (minus top-level ``exclude_dirs``) exists
+    with the same content in ``actual_dir``."""
+    for root, dirs, files in os.walk(expected_dir):
+        if root == expected_dir:
+            dirs[:] = [d for d in dirs if d not in exclude_dirs]
+        for file in files:
+            expected = os.path.join(root, file)
+            actual = os.path.join(actual_dir, os.path.relpath(expected, expected_dir))
+            if not os.path.exists(actual) or not filecmp.cmp(expected, actual, shallow=False):
+                return False
+    return True
+
+def check(condition, description):
+    print(f"{'ok  ' if condition else 'FAIL'} {description}")
+    if not condition:
+        sys.exit(1)
+
+@mock_aws
+def main():
+    """Round-trips data and artifacts through a moto S3 bucket and checks the sync guarantees."""
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir, artifacts_dir = os.path.join(tmp, 'data'), os.path.join(tmp, 'artifacts')
+        write_file(os.path.join(data_dir, 'mpd.slice.0-999.json'), '{"playlists": []}')
+        write_file(os.path.join(artifacts_dir, 'graph_data.pt'), 'graph v1')
+        write_file(os.path.join(artifacts_dir, 'playlist_songs_indptr.npy'), 'index')
+        # Ingest shards left in artifacts/ by older processing runs
+        write_file(os.path.join(artifacts_dir, 'shards', 'mpd.slice.0-999.npz'), 'shard')
+
+        sync_s3(BUCKET, 'upload', data_dir, artifacts_dir, s3_client=s3_client)
+        first_version = get_latest_s3_version(s3_client, BUCKET, 'artifacts/')
+        check(first_version is not None, "upload writes a manifest for the version")
+
+        # An upload still in progress: objects but no manifest yet
+        s3_client.put_object(Bucket=BUCKET, Key='artifacts/9999-12-31-23-59-59/graph_data.pt', Body=b'partial')
+        s3_client.put_object(Bucket=BUCKET, Key='data/9999-12-31-23-59-59/mpd.slice.0-999.json', Body=b'partial')
+        check(get_latest_s3_version(s3_client, BUCKET, 'artifacts/') == first_version,
+              "versions without a manifest are skipped")
+
+        download_data = os.path.join(tmp, 'download', 'data')
+        download_artifacts = os.path.join(tmp, 'download', 'artifacts')
+        sync_s3(BUCKET, 'download', download_data, download_artifacts, versioned=True, s3_client=s3_client)
+        first_dir = os.path.join(download_artifacts, first_version.rstrip('/').split('/')[-1])
+        check(same_tree(artifacts_dir, first_dir, EXCLUDED_ARTIFACT_DIRS),
+              "versioned download matches the uploaded artifacts")
+        check(not os.path.exists(os.path.join(first_dir, 'shards')), "ingest shards are not synced as artifacts")
+        check(same_tree(data_dir, download_data), "data download matches the uploaded data")
+        check(sorted(f for f in os.listdir(download_data) if not f.startswith('.')) == ['mpd.slice.0-999.json'],
+              f"data directory holds only MPD slices ({MANIFEST_NAME} stored as {LOCAL_MANIFEST_NAME})")
+        check(not os.path.exists(os.path.join(download_artifacts, '9999-12-31-23-59-59')),
+              "incomplete version is not downloaded")
+
+        # Second version: one file changed, the playlist index unchanged
+        for key in ('artifacts/9999-12-31-23-59-59/graph_data.pt', 'data/9999-12-31-23-59-59/mpd.slice.0-999.json'):
+            s3_client.delete_object(Bucket=BUCKET, Key=key)
+        write_file(os.path.join(artifacts_dir, 'graph_data.pt'), 'graph v2')
+        time.sleep(1)  # Versions are named by the second
+        sync_s3(BUCKET, 'upload', data_dir, artifacts_dir, s3_client=s3_client)
+        second_version = get_latest_s3_version(s3_client, BUCKET, 'artifacts/')
+        check(second_version != first_version, "second upload creates a new complete version")
+
+        sync_s3(BUCKET, 'download', download_data, download_artifacts, versioned=True, s3_client=s3_client)
+        second_dir = os.path.join(download_artifacts, second_version.rstrip('/').split('/')[-1])
+        check(same_tree(artifacts_dir, second_dir, EXCLUDED_ARTIFACT_DIRS),
+              "second versioned download matches the new artifacts")
+        unchanged = 'playlist_songs_indptr.npy'
+        check(os.path.samefile(os.path.join(first_dir, unchanged), os.path.join(second_dir, unchanged)),
+              "unchanged files are hard-linked from the earlier version")
+    print("All sync checks passed.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import argparse
+
+# Allow running as `python scripts/convert_mappings.py` from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.artifacts import (
+    PLAYLIST_MAPPING_NAME, SONG_MAPPING_NAME, load_json_mapping, save_mapping
+)
+
+def find_artifact_dirs(path):
+    """Returns ``path`` and any subdirectories (e.g. timestamped versions) that hold JSON mappings."""
+    candidates = [path] + [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    return [d for d in candidates
+            if os.path.isdir(d) and os.path.exists(os.path.join(d, f'{SONG_MAPPING_NAME}.json'))]
+
+def convert_artifact_dir(artifact_dir, remove_json=False):
+    """Writes the sorted-array form of both JSON mappings in ``artifact_dir``."""
+    for name in (SONG_MAPPING_NAME, PLAYLIST_MAPPING_NAME):
+        mapping = load_json_mapping(artifact_dir, name)
+        if mapping is None:
+            print(f"  {name}.json not found, skipping.")
+            continue
+        save_mapping(mapping, artifact_dir, name)
+        print(f"  {name}: {len(mapping)} entries converted.")
+        if remove_json:
+            os.remove(os.path.join(artifact_dir, f'{name}.json'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert song_mapping.json/playlist_mapping.json in existing artifact directories to memory-mappable arrays."
+    )
+    parser.add_argument('paths', nargs='+', help="Artifact directories, or roots of timestamped version directories.")
+    parser.add_argument('--remove-json', action='store_true', help="Delete the JSON files after converting.")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        artifact_dirs = find_artifact_dirs(path)
+        if not artifact_dirs:
+            print(f"No JSON mappings found under {path}.")
+        for artifact_dir in artifact_dirs:
+            print(f"Converting {artifact_dir}...")
+            convert_artifact_dir(artifact_dir, remove_json=args.remove_json)
@@ -1,9 +1,25 @@
 import boto3
+import hashlib
+import json
 import os
+import shutil
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+# Written last into every uploaded version: relative path -> sha256 and size
+MANIFEST_NAME = 'manifest.json'
+# Local copy of a downloaded version's manifest. Hidden, so it is neither
+# uploaded again nor picked up as an MPD slice from the data directory.
+LOCAL_MANIFEST_NAME = '.sync_manifest.json'
+# Ingest shards are written to work/shards now, but older runs left them in artifacts/shards
+EXCLUDED_ARTIFACT_DIRS = ('shards',)
+MB = 1024 * 1024
+
 def create_bucket_if_not_exists(s3_client, bucket_name):
     """Checks if an S3 bucket exists and creates it if it does not."""
     try:
@@ -37,71 +53,272 @@ def create_bucket_if_not_exists(s3_client, bucket_name):
             print(f"An unexpected error occurred when checking for the bucket: {e}")
             exit(1)
 
-def sync_s3(bucket_name, direction, local_data_dir='data', local_artifacts_dir='artifacts'):
+def file_sha256(path, chunk_size=8 * MB):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_local_manifest(local_dir, exclude_dirs=()):
+    """Hashes every non-hidden file under ``local_dir``, keyed by '/'-separated relative path.
+    Top-level directories named in ``exclude_dirs`` are skipped."""
+    manifest = {}
+    for root, dirs, files in os.walk(local_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not d.endswith('.partial')
+                         and not (root == local_dir and d in exclude_dirs))
+        for file in sorted(files):
+            if file.startswith('.') or file == MANIFEST_NAME: # Ignore hidden files like .DS_Store
+                continue
+            local_path = os.path.join(root, file)
+            rel_path = os.path.relpath(local_path, local_dir).replace(os.sep, '/')
+            manifest[rel_path] = {'sha256': file_sha256(local_path), 'size': os.path.getsize(local_path)}
+    return manifest
+
+def list_objects(s3_client, bucket_name, prefix):
+    """Returns {key: size} for every object under ``prefix``, across all result pages."""
+    paginator = s3_client.get_paginator('list_objects_v2')
+    objects = {}
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = obj['Size']
+    return objects
+
+def has_remote_manifest(s3_client, bucket_name, version_prefix):
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=version_prefix + MANIFEST_NAME)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return False
+        raise
+    return True
+
+def get_latest_s3_version(s3_client, bucket_name, prefix, allow_legacy=False):
+    """Returns the newest complete '<prefix><timestamp>/' prefix, or None if there is none.
+
+    A version is complete once its manifest is written, which is the last step
+    of an upload, so versions still being uploaded (or whose upload failed) are
+    skipped. With ``allow_legacy=True`` the newest version is used when none
+    has a manifest, for buckets uploaded before manifests existed.
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    versions = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        versions.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+    for version in sorted(versions, reverse=True):
+        if has_remote_manifest(s3_client, bucket_name, version):
+            return version
+        print(f"Skipping {version}: no manifest (upload incomplete or uploaded before manifests).")
+    if allow_legacy and versions:
+        return max(versions)
+    return None
+
+def read_remote_manifest(s3_client, bucket_name, version_prefix):
+    """Returns the manifest of an uploaded version, or None for versions uploaded without one."""
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=version_prefix + MANIFEST_NAME)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())['files']
+
+def with_retries(fn, description, attempts=5, base_delay=1.0):
+    """Calls ``fn`` until it succeeds, backing off exponentially between attempts."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = base_delay * 2 ** (attempt - 1)
+            print(f"  - {description} failed ({e}); retrying in {delay:.0f}s ({attempt}/{attempts - 1})")
+            time.sleep(delay)
+
+def run_transfers(tasks, max_workers):
+    """Runs (description, fn) pairs in a thread pool. Returns the descriptions that failed."""
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(with_retries, fn, description): description for description, fn in tasks}
+        for future in as_completed(futures):
+            description = futures[future]
+            try:
+                future.result()
+                print(f"  - {description}")
+            except Exception as e:
+                print(f"  - FAILED {description}: {e}")
+                failed.append(description)
+    return failed
+
+def upload_tree(s3_client, bucket_name, local_dir, prefix, previous_prefix, transfer_config, max_workers,
+                exclude_dirs=()):
+    """Uploads ``local_dir`` (minus top-level ``exclude_dirs``) to ``prefix``. Files whose hash
+    matches the manifest of ``previous_prefix`` are copied server-side instead of re-uploaded."""
+    manifest = build_local_manifest(local_dir, exclude_dirs)
+    previous = read_remote_manifest(s3_client, bucket_name, previous_prefix) if previous_prefix else None
+    previous = previous or {}
+
+    tasks = []
+    copied = 0
+    for rel_path, entry in manifest.items():
+        key = prefix + rel_path
+        if previous.get(rel_path, {}).get('sha256') == entry['sha256']:
+            source = {'Bucket': bucket_name, 'Key': previous_prefix + rel_path}
+            tasks.append((f"Copied unchanged {rel_path} from {previous_prefix}",
+                          lambda source=source, key=key: s3_client.copy(source, bucket_name, key, Config=transfer_config)))
+            copied += 1
+        else:
+            local_path = os.path.join(local_dir, *rel_path.split('/'))
+            tasks.append((f"Uploaded {local_path} to {key}",
+                          lambda local_path=local_path, key=key: s3_client.upload_file(
+                              local_path, bucket_name, key, Config=transfer_config)))
+    print(f"{len(manifest) - copied} files to upload, {copied} unchanged since the previous version.")
+
+    failed = run_transfers(tasks, max_workers)
+    if failed:
+        # Without a manifest the version is never used as the base of the next upload
+        print(f"{len(failed)} transfers failed; {prefix} is incomplete and has no manifest.")
+        return False
+    s3_client.put_object(Bucket=bucket_name, Key=prefix + MANIFEST_NAME,
+                         Body=json.dumps({'files': manifest}).encode())
+    return True
+
+def _local_sources(link_dirs):
+    """Maps sha256 -> path for files of earlier local downloads, read from their manifests."""
+    sources = {}
+    for link_dir in link_dirs:
+        manifest_path = os.path.join(link_dir, LOCAL_MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            continue
+        with open(manifest_path, 'r') as f:
+            for rel_path, entry in json.load(f)['files'].items():
+                path = os.path.join(link_dir, *rel_path.split('/'))
+                if os.path.exists(path) and os.path.getsize(path) == entry['size']:
+                    sources.setdefault(entry['sha256'], path)
+    return sources
+
+def _is_current(local_path, entry, size):
+    """True if ``local_path`` already holds the remote file (by hash, or by size without a manifest)."""
+    if not os.path.exists(local_path) or os.path.getsize(local_path) != size:
+        return False
+    return entry is None or file_sha256(local_path) == entry['sha256']
+
+def download_tree(s3_client, bucket_name, prefix, local_dir, transfer_config, max_workers, link_dirs=()):
+    """Downloads every object under ``prefix`` into ``local_dir``.
+
+    Files already present with the right content (e.g. from an interrupted run)
+    are kept, and files identical to one in ``link_dirs`` are hard-linked from
+    there. Returns True if everything is in place.
+    """
+    objects = list_objects(s3_client, bucket_name, prefix)
+    manifest = read_remote_manifest(s3_client, bucket_name, prefix)
+    sources = _local_sources(link_dirs) if manifest else {}
+    os.makedirs(local_dir, exist_ok=True)
+
+    tasks = []
+    kept = linked = 0
+    for key, size in sorted(objects.items()):
+        rel_path = key[len(prefix):]
+        if not rel_path or rel_path == MANIFEST_NAME:
+            continue
+        local_path = os.path.join(local_dir, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        entry = manifest.get(rel_path) if manifest else None
+        if _is_current(local_path, entry, size):
+            kept += 1
+            continue
+        source = sources.get(entry['sha256']) if entry else None
+        if source is not None:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+            try:
+                os.link(source, local_path)
+            except OSError:
+                shutil.copy2(source, local_path) # e.g. a different filesystem
+            linked += 1
+            continue
+        tasks.append((f"Downloaded {key} to {local_path}",
+                      lambda key=key, local_path=local_path: s3_client.download_file(
+                          bucket_name, key, local_path, Config=transfer_config)))
+    print(f"{len(tasks)} files to download, {kept} already present, {linked} linked from earlier versions.")
+
+    failed = run_transfers(tasks, max_workers)
+    if failed:
+        print(f"{len(failed)} transfers failed; re-run to resume.")
+        return False
+    if manifest is not None:
+        with open(os.path.join(local_dir, LOCAL_MANIFEST_NAME), 'w') as f:
+            json.dump({'files': manifest}, f)
+    return True
+
+def sync_s3(bucket_name, direction, local_data_dir='data', local_artifacts_dir='artifacts', versioned=False,
+            max_workers=8, endpoint_url=None, s3_client=None, allow_legacy=False):
     """
     Uploads or downloads data and artifacts to/from an S3 bucket with versioning.
+
+    Files are transferred ``max_workers`` at a time (large ones in multipart
+    chunks), and each uploaded version gets a manifest of content hashes:
+    uploads copy files that are unchanged since the previous version
+    server-side, and downloads skip files that are already present and
+    hard-link files unchanged from an earlier local version. Failed transfers
+    are retried with backoff; re-running after an interruption resumes.
+
+    With ``versioned=True``, downloads keep the S3 version in the local layout
+    (``artifacts/<version>/``) so a running API can hot-reload it. The files are
+    first written to ``<version>.partial`` and renamed when complete, so the
+    API's artifact watcher never picks up a half-downloaded version. Only
+    versions whose upload completed (wrote its manifest) are downloaded, unless
+    ``allow_legacy`` permits versions uploaded before manifests existed.
+
+    ``endpoint_url`` (or an explicit ``s3_client``) points the sync at an
+    S3-compatible stand-in such as MinIO or moto.
     """
-    s3_client = boto3.client('s3')
+    if s3_client is None:
+        s3_client = boto3.client(
+            's3', endpoint_url=endpoint_url,
+            config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=max_workers * 4)
+        )
+    transfer_config = TransferConfig(
+        multipart_threshold=64 * MB, multipart_chunksize=64 * MB, max_concurrency=4, use_threads=True
+    )
 
     if direction == 'upload':
         # --- THIS IS THE NEW LOGIC ---
         # Ensure the bucket exists before we try to upload to it.
         create_bucket_if_not_exists(s3_client, bucket_name)
-        
+
+        previous_data_prefix = get_latest_s3_version(s3_client, bucket_name, 'data/')
+        previous_artifacts_prefix = get_latest_s3_version(s3_client, bucket_name, 'artifacts/')
         version = datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
         print(f"Creating new version: {version}")
 
         # --- Upload Data ---
         s3_data_prefix = f'data/{version}/'
         print(f"\nUploading raw data to s3://{bucket_name}/{s3_data_prefix}...")
-        for root, _, files in os.walk(local_data_dir):
-            for file in files:
-                if not file.startswith('.'): # Ignore hidden files like .DS_Store
-                    local_path = os.path.join(root, file)
-                    s3_key = os.path.join(s3_data_prefix, file)
-                    try:
-                        s3_client.upload_file(local_path, bucket_name, s3_key)
-                        print(f"  - Uploaded {local_path} to {s3_key}")
-                    except Exception as e:
-                        print(f"  - Failed to upload {local_path}: {e}")
+        data_ok = upload_tree(s3_client, bucket_name, local_data_dir, s3_data_prefix, previous_data_prefix,
+                              transfer_config, max_workers)
 
         # --- Upload Artifacts ---
         s3_artifacts_prefix = f'artifacts/{version}/'
         print(f"\nUploading artifacts to s3://{bucket_name}/{s3_artifacts_prefix}...")
-        for root, _, files in os.walk(local_artifacts_dir):
-            for file in files:
-                 if not file.startswith('.'):
-                    local_path = os.path.join(root, file)
-                    s3_key = os.path.join(s3_artifacts_prefix, file)
-                    try:
-                        s3_client.upload_file(local_path, bucket_name, s3_key)
-                        print(f"  - Uploaded {local_path} to {s3_key}")
-                    except Exception as e:
-                        print(f"  - Failed to upload {local_path}: {e}")
-        
-        print(f"\nUpload complete. Latest version is: {version}")
+        artifacts_ok = upload_tree(s3_client, bucket_name, local_artifacts_dir, s3_artifacts_prefix,
+                                   previous_artifacts_prefix, transfer_config, max_workers,
+                                   exclude_dirs=EXCLUDED_ARTIFACT_DIRS)
+
+        if data_ok and artifacts_ok:
+            print(f"\nUpload complete. Latest version is: {version}")
+        else:
+            print(f"\nUpload of version {version} finished with errors.")
 
     elif direction == 'download':
         # To download, we first need to find the latest version
         print("Finding the latest version in S3...")
-        
-        # We look for the latest timestamped folder in both data and artifacts
-        def get_latest_s3_version(prefix):
-            paginator = s3_client.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/')
-            latest_version = None
-            for page in pages:
-                if 'CommonPrefixes' in page:
-                    versions = [p['Prefix'] for p in page['CommonPrefixes']]
-                    if versions:
-                        latest_version = max(versions)
-            return latest_version
-
-        latest_data_version_prefix = get_latest_s3_version('data/')
-        latest_artifacts_version_prefix = get_latest_s3_version('artifacts/')
+        latest_data_version_prefix = get_latest_s3_version(s3_client, bucket_name, 'data/', allow_legacy)
+        latest_artifacts_version_prefix = get_latest_s3_version(s3_client, bucket_name, 'artifacts/', allow_legacy)
 
         if not latest_data_version_prefix or not latest_artifacts_version_prefix:
-            print("Could not find any versions in the S3 bucket. Please upload first.")
+            print("Could not find any complete versions in the S3 bucket. Please upload first "
+                  "(or pass --allow-legacy for versions uploaded without a manifest).")
             return
 
         print(f"Latest data version found: {latest_data_version_prefix}")
@@ -109,31 +326,35 @@ def sync_s3(bucket_name, direction, local_data_dir='data', local_artifacts_dir='
 
         # --- Download Data ---
         print(f"\nDownloading raw data from {latest_data_version_prefix}...")
-        os.makedirs(local_data_dir, exist_ok=True)
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=latest_data_version_prefix)
-        for obj in response.get('Contents', []):
-            s3_key = obj['Key']
-            local_path = os.path.join(local_data_dir, os.path.basename(s3_key))
-            try:
-                s3_client.download_file(bucket_name, s3_key, local_path)
-                print(f"  - Downloaded {s3_key} to {local_path}")
-            except Exception as e:
-                print(f"  - Failed to download {s3_key}: {e}")
+        data_ok = download_tree(s3_client, bucket_name, latest_data_version_prefix, local_data_dir,
+                                transfer_config, max_workers)
 
         # --- Download Artifacts ---
         print(f"\nDownloading artifacts from {latest_artifacts_version_prefix}...")
-        os.makedirs(local_artifacts_dir, exist_ok=True)
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=latest_artifacts_version_prefix)
-        for obj in response.get('Contents', []):
-            s3_key = obj['Key']
-            local_path = os.path.join(local_artifacts_dir, os.path.basename(s3_key))
-            try:
-                s3_client.download_file(bucket_name, s3_key, local_path)
-                print(f"  - Downloaded {s3_key} to {local_path}")
-            except Exception as e:
-                print(f"  - Failed to download {s3_key}: {e}")
+        final_artifacts_dir = None
+        link_dirs = []
+        if versioned:
+            version_name = latest_artifacts_version_prefix.rstrip('/').split('/')[-1]
+            final_artifacts_dir = os.path.join(local_artifacts_dir, version_name)
+            if os.path.isdir(final_artifacts_dir):
+                print(f"Artifacts version {version_name} is already at {final_artifacts_dir}.")
+                return
+            # Earlier versions already on disk, to hard-link unchanged files from
+            if os.path.isdir(local_artifacts_dir):
+                link_dirs = [os.path.join(local_artifacts_dir, name) for name in sorted(os.listdir(local_artifacts_dir))
+                             if os.path.isdir(os.path.join(local_artifacts_dir, name)) and not name.endswith('.partial')]
+            local_artifacts_dir = final_artifacts_dir + '.partial'
+        artifacts_ok = download_tree(s3_client, bucket_name, latest_artifacts_version_prefix, local_artifacts_dir,
+                                     transfer_config, max_workers, link_dirs=link_dirs)
 
-        print("\nDownload complete.")
+        if final_artifacts_dir is not None and artifacts_ok:
+            os.replace(local_artifacts_dir, final_artifacts_dir)
+            print(f"Artifacts available at {final_artifacts_dir}")
+
+        if data_ok and artifacts_ok:
+            print("\nDownload complete.")
+        else:
+            print("\nDownload incomplete; re-run to resume.")
     else:
         print(f"Invalid direction '{direction}'. Please choose 'upload' or 'download'.")
 
@@ -142,6 +363,14 @@ if __name__ == '__main__':
     parser.add_argument('--bucket', type=str, required=True, help="The name of your S3 bucket (must be globally unique).")
     parser.add_argument('--direction', type=str, required=True, choices=['upload', 'download'],
                         help="Direction of synchronization.")
+    parser.add_argument('--versioned', action='store_true',
+                        help="Download artifacts into artifacts/<version>/ instead of overwriting artifacts/.")
+    parser.add_argument('--workers', type=int, default=8, help="Files transferred concurrently.")
+    parser.add_argument('--endpoint-url', type=str, default=os.getenv('S3_ENDPOINT_URL'),
+                        help="S3-compatible endpoint, e.g. a local MinIO or moto server.")
+    parser.add_argument('--allow-legacy', action='store_true',
+                        help="Download the newest version even without a manifest when no version has one.")
     args = parser.parse_args()
 
-    sync_s3(args.bucket, args.direction)
\ No newline at end of file
+    sync_s3(args.bucket, args.direction, versioned=args.versioned, max_workers=args.workers,
+            endpoint_url=args.endpoint_url, allow_legacy=args.allow_legacy)
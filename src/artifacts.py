@@ -0,0 +1,486 @@
+# src/artifacts.py
+import hashlib
+import json
+import os
+import struct
+import uuid
+import numpy as np
+
+PLAYLIST_INDPTR_FILE = 'playlist_songs_indptr.npy'
+PLAYLIST_INDICES_FILE = 'playlist_songs_indices.npy'
+
+
+class PlaylistIndex:
+    """CSR-style playlist -> song-index lookup.
+
+    The songs of playlist ``i`` are ``indices[indptr[i]:indptr[i + 1]]``, so
+    fetching them costs O(playlist length) regardless of corpus size.
+    """
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    @property
+    def num_playlists(self):
+        return len(self.indptr) - 1
+
+    def songs(self, playlist_idx):
+        """Returns a copy of the song indices of a playlist as an int64 array."""
+        start, end = self.indptr[playlist_idx], self.indptr[playlist_idx + 1]
+        return np.array(self.indices[start:end], dtype=np.int64)
+
+    def seen_pairs(self, playlist_indices):
+        """Returns (row, song_index) arrays covering every song of every given playlist.
+
+        ``row`` is the position in ``playlist_indices``, so the pairs can be used
+        directly to mask a [len(playlist_indices), num_songs] score matrix.
+        """
+        rows, positions = self.pair_positions(playlist_indices)
+        return rows, np.asarray(self.indices[positions], dtype=np.int64)
+
+    def pair_positions(self, playlist_indices):
+        """Like seen_pairs, but returns positions into ``indices`` instead of song indices,
+        for looking up values stored alongside them."""
+        playlist_indices = np.asarray(playlist_indices, dtype=np.int64)
+        starts = np.asarray(self.indptr[playlist_indices])
+        lengths = np.asarray(self.indptr[playlist_indices + 1]) - starts
+
+        rows = np.repeat(np.arange(len(playlist_indices)), lengths)
+        row_offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.arange(lengths.sum()) - row_offsets + np.repeat(starts, lengths)
+        return rows, positions
+
+
+def build_playlist_index(song_indices, playlist_indices, num_playlists):
+    """Builds a PlaylistIndex from parallel song/playlist edge arrays."""
+    song_indices = np.asarray(song_indices, dtype=np.int64)
+    playlist_indices = np.asarray(playlist_indices, dtype=np.int64)
+
+    order = np.argsort(playlist_indices, kind='stable')
+    counts = np.bincount(playlist_indices, minlength=num_playlists)
+    indptr = np.zeros(num_playlists + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return PlaylistIndex(indptr, song_indices[order])
+
+
+def extend_playlist_index(playlist_index, song_indices, playlist_indices, num_playlists):
+    """Returns a new PlaylistIndex with extra edges merged in, in linear time.
+
+    ``num_playlists`` may exceed the old count when the new edges introduce
+    playlists; existing songs of each playlist keep their order and new ones
+    are appended after them.
+    """
+    old_indptr = np.asarray(playlist_index.indptr)
+    old_indices = np.asarray(playlist_index.indices)
+    delta = build_playlist_index(song_indices, playlist_indices, num_playlists)
+
+    old_counts = np.zeros(num_playlists, dtype=np.int64)
+    old_counts[:len(old_indptr) - 1] = np.diff(old_indptr)
+    delta_counts = np.diff(delta.indptr)
+
+    indptr = np.zeros(num_playlists + 1, dtype=np.int64)
+    np.cumsum(old_counts + delta_counts, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int64)
+
+    # Old entries shift by how much earlier playlists grew
+    old_rows = np.repeat(np.arange(num_playlists), old_counts)
+    indices[indptr[old_rows] + np.arange(len(old_indices)) - old_indptr[old_rows]] = old_indices
+
+    # New entries go right after each playlist's old entries
+    delta_rows = np.repeat(np.arange(num_playlists), delta_counts)
+    rank_in_row = np.arange(len(delta.indices)) - delta.indptr[delta_rows]
+    indices[indptr[delta_rows] + old_counts[delta_rows] + rank_in_row] = delta.indices
+    return PlaylistIndex(indptr, indices)
+
+
+def save_playlist_index(playlist_index, output_dir):
+    """Writes the CSR arrays of a PlaylistIndex as .npy files."""
+    np.save(os.path.join(output_dir, PLAYLIST_INDPTR_FILE), playlist_index.indptr)
+    np.save(os.path.join(output_dir, PLAYLIST_INDICES_FILE), playlist_index.indices)
+
+
+def load_playlist_index(artifact_dir, mmap_mode='r'):
+    """Memory-maps a saved PlaylistIndex, or returns None if it was never written."""
+    indptr_path = os.path.join(artifact_dir, PLAYLIST_INDPTR_FILE)
+    indices_path = os.path.join(artifact_dir, PLAYLIST_INDICES_FILE)
+    if not (os.path.exists(indptr_path) and os.path.exists(indices_path)):
+        return None
+    return PlaylistIndex(
+        np.load(indptr_path, mmap_mode=mmap_mode),
+        np.load(indices_path, mmap_mode=mmap_mode)
+    )
+
+
+SONG_METADATA_COLUMNS = ['track_name_x', 'artists']
+
+
+class StringPool:
+    """Read-only table of UTF-8 strings stored as one byte buffer plus offsets."""
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.data[start:end].tobytes().decode('utf-8')
+
+    def take(self, indices):
+        """Returns the strings at the given integer positions, in order."""
+        return [self[int(i)] for i in indices]
+
+
+def build_string_pool(strings):
+    """Packs an iterable of strings into a StringPool."""
+    encoded = [str(s).encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return StringPool(offsets, data)
+
+
+def concat_string_pools(first, second):
+    """Returns a StringPool holding the strings of ``first`` followed by ``second``."""
+    first_data = np.asarray(first.data)
+    offsets = np.concatenate([np.asarray(first.offsets), np.asarray(second.offsets[1:]) + len(first_data)])
+    return StringPool(offsets, np.concatenate([first_data, np.asarray(second.data)]))
+
+
+def _string_pool_paths(output_dir, name):
+    return (os.path.join(output_dir, f'{name}_offsets.npy'),
+            os.path.join(output_dir, f'{name}_data.npy'))
+
+
+def save_string_pool(pool, output_dir, name):
+    offsets_path, data_path = _string_pool_paths(output_dir, name)
+    np.save(offsets_path, pool.offsets)
+    np.save(data_path, pool.data)
+
+
+def load_string_pool(artifact_dir, name, mmap_mode='r'):
+    offsets_path, data_path = _string_pool_paths(artifact_dir, name)
+    if not (os.path.exists(offsets_path) and os.path.exists(data_path)):
+        return None
+    return StringPool(np.load(offsets_path, mmap_mode=mmap_mode), np.load(data_path, mmap_mode=mmap_mode))
+
+
+def build_song_metadata_pools(songs_df):
+    """Builds one StringPool per metadata column; row i must describe song index i."""
+    return {col: build_string_pool(songs_df[col]) for col in SONG_METADATA_COLUMNS}
+
+
+def save_song_metadata(songs_df, output_dir):
+    """Writes the song metadata pools of ``songs_df`` to ``output_dir``."""
+    for col, pool in build_song_metadata_pools(songs_df).items():
+        save_string_pool(pool, output_dir, f'song_metadata_{col}')
+
+
+def append_song_metadata(songs_df, output_dir):
+    """Appends rows for new songs (in song-index order) to the saved metadata pools."""
+    existing = load_song_metadata(output_dir)
+    for col, pool in build_song_metadata_pools(songs_df).items():
+        # Loaded fully into memory, since the files are about to be overwritten
+        merged = concat_string_pools(existing[col], pool)
+        save_string_pool(merged, output_dir, f'song_metadata_{col}')
+
+
+def load_song_metadata(artifact_dir):
+    """Memory-maps the song metadata pools, or returns None if any are missing."""
+    pools = {col: load_string_pool(artifact_dir, f'song_metadata_{col}') for col in SONG_METADATA_COLUMNS}
+    if any(pool is None for pool in pools.values()):
+        return None
+    return pools
+
+
+SONG_MAPPING_NAME = 'song_mapping'
+PLAYLIST_MAPPING_NAME = 'playlist_mapping'
+
+
+class SortedMapping:
+    """Read-only key -> node-index lookup backed by two aligned arrays.
+
+    ``keys`` is sorted (int64 playlist IDs, or fixed-width UTF-8 bytes for track
+    IDs) and ``values[i]`` is the node index of ``keys[i]``; lookups are binary
+    searches, so both arrays can stay memory-mapped. Node indices are assumed
+    to be 0..len-1, as produced by create_graph_data.
+    """
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+        self._positions = None  # node index -> position in keys, built on first reverse lookup
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.lookup([key])[0] >= 0
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.lookup([key])[0]
+        return int(value) if value >= 0 else default
+
+    def _as_keys(self, keys):
+        """Returns (query array, mask of keys that fit the key dtype)."""
+        if self.keys.dtype.kind == 'S':
+            query = np.char.encode(np.asarray(keys, dtype=str), 'utf-8')
+            return query, np.ones(len(query), dtype=bool)
+        try:
+            query = np.asarray(keys, dtype=self.keys.dtype)
+            return query, np.ones(len(query), dtype=bool)
+        except OverflowError:
+            # Python ints beyond int64 (e.g. a huge playlist_id) can't be stored, so can't be known
+            info = np.iinfo(self.keys.dtype)
+            valid = np.array([info.min <= key <= info.max for key in keys], dtype=bool)
+            return np.asarray([key if ok else 0 for key, ok in zip(keys, valid)], dtype=self.keys.dtype), valid
+
+    def lookup(self, keys):
+        """Returns the node indices of ``keys`` as an int64 array, with -1 for unknown keys
+        (including integer keys outside the key dtype's range)."""
+        query, valid = self._as_keys(keys)
+        if len(self.keys) == 0:
+            return np.full(len(query), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        found = (self.keys[positions] == query) & valid
+        return np.where(found, self.values[positions], -1).astype(np.int64)
+
+    def keys_for(self, node_indices):
+        """Returns the keys of the given node indices (str for string mappings)."""
+        if self._positions is None:
+            positions = np.empty(len(self.values), dtype=np.int64)
+            positions[np.asarray(self.values)] = np.arange(len(self.values))
+            self._positions = positions
+        keys = np.asarray(self.keys[self._positions[np.asarray(node_indices, dtype=np.int64)]])
+        return np.char.decode(keys, 'utf-8') if keys.dtype.kind == 'S' else keys
+
+    def ordered_keys(self):
+        """Returns all keys in node-index order."""
+        return self.keys_for(np.arange(len(self)))
+
+
+def build_sorted_mapping(keys, values=None):
+    """Builds a SortedMapping; ``values`` defaults to each key's position in ``keys``."""
+    keys = np.asarray(keys)
+    if keys.dtype.kind in 'OU':
+        # Fixed-width bytes sort and compare like the UTF-8 strings they encode
+        keys = np.char.encode(keys.astype(str), 'utf-8') if len(keys) else np.array([], dtype='S1')
+    else:
+        keys = keys.astype(np.int64)
+    values = np.arange(len(keys), dtype=np.int64) if values is None else np.asarray(values, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    return SortedMapping(keys[order], values[order])
+
+
+def _mapping_paths(output_dir, name):
+    return (os.path.join(output_dir, f'{name}_keys.npy'),
+            os.path.join(output_dir, f'{name}_values.npy'))
+
+
+def save_mapping(mapping, output_dir, name):
+    keys_path, values_path = _mapping_paths(output_dir, name)
+    np.save(keys_path, np.asarray(mapping.keys))
+    np.save(values_path, np.asarray(mapping.values))
+
+
+def load_mapping(artifact_dir, name, mmap_mode='r'):
+    """Memory-maps a saved SortedMapping, or returns None if it is missing."""
+    keys_path, values_path = _mapping_paths(artifact_dir, name)
+    if not (os.path.exists(keys_path) and os.path.exists(values_path)):
+        return None
+    return SortedMapping(np.load(keys_path, mmap_mode=mmap_mode), np.load(values_path, mmap_mode=mmap_mode))
+
+
+def load_json_mapping(artifact_dir, name):
+    """Reads a legacy ``{name}.json`` mapping into a SortedMapping, or returns None if it is missing."""
+    path = os.path.join(artifact_dir, f'{name}.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        raw = json.load(f)
+    keys = list(raw.keys())
+    if name == PLAYLIST_MAPPING_NAME:
+        keys = [int(key) for key in keys]  # JSON object keys are always strings
+    return build_sorted_mapping(keys, list(raw.values()))
+
+
+def load_mappings(artifact_dir):
+    """Returns the (song, playlist) mappings, falling back to the legacy JSON files."""
+    mappings = []
+    for name in (SONG_MAPPING_NAME, PLAYLIST_MAPPING_NAME):
+        mapping = load_mapping(artifact_dir, name)
+        if mapping is None:
+            print(f"{name} arrays not found, reading {name}.json (run scripts/convert_mappings.py to speed this up)...")
+            mapping = load_json_mapping(artifact_dir, name)
+        if mapping is None:
+            raise FileNotFoundError(f"No {name} found in {artifact_dir}.")
+        mappings.append(mapping)
+    return tuple(mappings)
+
+
+EMBEDDING_MAGIC = b'GNNEMB\x00\x01'
+EMBEDDING_FORMAT_VERSION = 2
+# Version 1 headers lack the graph id and weights digest; they are still read
+SUPPORTED_EMBEDDING_FORMAT_VERSIONS = (1, 2)
+EMBEDDING_HEADER_SIZE = 128  # Keeps the float payload page/cache-line aligned
+SONG_EMBEDDINGS_FILE = 'song_embeddings.emb'
+PLAYLIST_EMBEDDINGS_FILE = 'playlist_embeddings.emb'
+# Inputs to the seed-track (cold-start) encoder: GNN input features and first-layer outputs per song
+SONG_FEATURES_FILE = 'song_features.emb'
+SONG_HIDDEN_FILE = 'song_hidden.emb'
+
+
+def _sha256_of_array(array, chunk_rows=65536):
+    digest = hashlib.sha256()
+    for start in range(0, array.shape[0], chunk_rows):
+        digest.update(np.ascontiguousarray(array[start:start + chunk_rows]).tobytes())
+    return digest.digest()
+
+
+def save_embedding_matrix(array, path, graph_id=None, weights_sha256=None):
+    """Writes a 2-D float32 matrix as a fixed header followed by the raw row-major data.
+
+    Header layout (little-endian): magic (8 bytes), format version (uint32),
+    rows (uint64), cols (uint64), numpy dtype string (8 bytes, NUL-padded), the
+    SHA-256 of the payload (32 bytes), the id of the graph build (16 bytes) and
+    the SHA-256 of the model weights (32 bytes) the embeddings were computed
+    from, zero-padded to EMBEDDING_HEADER_SIZE. Unknown ids are stored as zeros.
+    The file is written to a temporary name and renamed, so readers never see
+    a partial file.
+    """
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    header = struct.pack(
+        '<8sIQQ8s32s16s32s', EMBEDDING_MAGIC, EMBEDDING_FORMAT_VERSION,
+        array.shape[0], array.shape[1], array.dtype.str.encode('ascii'), _sha256_of_array(array),
+        bytes.fromhex(graph_id) if graph_id else b'', bytes.fromhex(weights_sha256) if weights_sha256 else b''
+    ).ljust(EMBEDDING_HEADER_SIZE, b'\x00')
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        array.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_embedding_header(path):
+    """Parses and validates the header of an embedding file."""
+    with open(path, 'rb') as f:
+        raw = f.read(EMBEDDING_HEADER_SIZE)
+    magic, version, rows, cols, dtype, checksum, graph_id, weights_sha256 = struct.unpack_from(
+        '<8sIQQ8s32s16s32s', raw
+    )
+    if magic != EMBEDDING_MAGIC:
+        raise ValueError(f"{path} is not an embedding file (bad magic {magic!r}).")
+    if version not in SUPPORTED_EMBEDDING_FORMAT_VERSIONS:
+        raise ValueError(f"{path} has format version {version}, expected one of {SUPPORTED_EMBEDDING_FORMAT_VERSIONS}.")
+    return {
+        'rows': rows,
+        'cols': cols,
+        'dtype': np.dtype(dtype.rstrip(b'\x00').decode('ascii')),
+        'checksum': checksum.hex(),
+        # Version 1 padding is all zeros, so both read as unknown
+        'graph_id': graph_id.hex() if any(graph_id) else None,
+        'weights_sha256': weights_sha256.hex() if any(weights_sha256) else None,
+    }
+
+
+def load_embedding_matrix(path, verify=False):
+    """Memory-maps an embedding file, returning (array, header).
+
+    The map is copy-on-write, so processes mapping the same file share its
+    pages. ``verify`` re-hashes the payload against the header checksum, which
+    reads the whole file.
+    """
+    header = read_embedding_header(path)
+    array = np.memmap(path, dtype=header['dtype'], mode='c', offset=EMBEDDING_HEADER_SIZE,
+                      shape=(header['rows'], header['cols']))
+    if verify and _sha256_of_array(array).hex() != header['checksum']:
+        raise ValueError(f"Checksum mismatch for {path}; the file is corrupt or was modified.")
+    return array, header
+
+
+def has_exported_embeddings(artifact_dir):
+    return all(os.path.exists(os.path.join(artifact_dir, name))
+               for name in (SONG_EMBEDDINGS_FILE, PLAYLIST_EMBEDDINGS_FILE))
+
+
+def file_sha256(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def exported_embeddings_mismatch(artifact_dir, num_songs, num_playlists, weights_path):
+    """Returns why the exported embeddings don't match the other artifacts, or None if they do.
+
+    Row counts are compared with the mappings, and the graph id and weights
+    digest recorded at export with the current graph build and model weights.
+    Exports written before those were recorded only get the row-count check.
+    """
+    song_header = read_embedding_header(os.path.join(artifact_dir, SONG_EMBEDDINGS_FILE))
+    playlist_header = read_embedding_header(os.path.join(artifact_dir, PLAYLIST_EMBEDDINGS_FILE))
+    if song_header['rows'] != num_songs or playlist_header['rows'] != num_playlists:
+        return (f"Exported embeddings cover {song_header['rows']} songs and {playlist_header['rows']} playlists, "
+                f"but the mappings have {num_songs} songs and {num_playlists} playlists.")
+    graph_id = load_graph_id(artifact_dir)
+    if song_header['graph_id'] is not None and graph_id is not None and song_header['graph_id'] != graph_id:
+        return "Exported embeddings were computed from an earlier graph build."
+    if song_header['weights_sha256'] is not None and os.path.exists(weights_path) \
+            and song_header['weights_sha256'] != file_sha256(weights_path):
+        return "Exported embeddings were computed from different model weights."
+    return None
+
+
+def embedding_stamp_mismatch(built, current):
+    """Returns why an index built from the embeddings stamped ``built`` doesn't
+    match the ``current`` ones, or None if it does.
+
+    Stamps are dicts of 'embeddings_checksum' (exported embeddings only),
+    'graph_id' and 'weights_sha256'. The checksums are compared when both are
+    known; otherwise the graph build and weights are. Unknown (None) values
+    are not compared, so stamps written before a field existed stay valid.
+    """
+    if built.get('embeddings_checksum') and current.get('embeddings_checksum'):
+        if built['embeddings_checksum'] != current['embeddings_checksum']:
+            return "was built from different exported embeddings"
+        return None
+    if built.get('graph_id') and current.get('graph_id') and built['graph_id'] != current['graph_id']:
+        return "was built from an earlier graph build"
+    if built.get('weights_sha256') and current.get('weights_sha256') \
+            and built['weights_sha256'] != current['weights_sha256']:
+        return "was built from different model weights"
+    return None
+
+
+
+GRAPH_ID_FILE = 'graph_id.txt'
+
+
+def save_graph_id(output_dir):
+    """Gives the graph in ``output_dir`` a new random id; call after every (re)build."""
+    graph_id = uuid.uuid4().hex
+    with open(os.path.join(output_dir, GRAPH_ID_FILE), 'w') as f:
+        f.write(graph_id)
+    return graph_id
+
+
+def load_graph_id(artifact_dir):
+    """Returns the id of the graph build in ``artifact_dir``, or None for older artifacts."""
+    path = os.path.join(artifact_dir, GRAPH_ID_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+# (2, num_edges) int64 array of the (song, playlist) pairs that training held out as
+# its test split; ``main.py --stage evaluate`` hides exactly these pairs.
+HOLDOUT_EDGES_FILE = 'holdout_edges.npy'
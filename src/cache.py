@@ -0,0 +1,114 @@
+# src/cache.py
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class RecommendationCache:
+    """Thread-safe LRU cache with a TTL, used to keep ranked song-index lists between page requests.
+
+    Concurrent misses on the same key are single-flighted: the first caller
+    computes the value and the others wait on its result. ``clear()`` drops
+    everything and stops in-flight computations from being stored, so it can be
+    called when the model artifacts are reloaded.
+    """
+    def __init__(self, max_entries=10000, ttl_seconds=600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._in_flight = {}  # key -> Future
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached value for ``key``, calling ``compute()`` once on a miss."""
+        hit, value, future, generation = self._lookup(key)
+        if hit:
+            return value
+        if generation is None:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._store(key, value, future, generation)
+        return value
+
+    async def aget_or_compute(self, key, compute):
+        """Async variant of get_or_compute; ``compute`` is a coroutine function."""
+        hit, value, future, generation = self._lookup(key)
+        if hit:
+            return value
+        if generation is None:
+            return await asyncio.wrap_future(future)
+
+        try:
+            value = await compute()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._store(key, value, future, generation)
+        return value
+
+    def _lookup(self, key):
+        """Returns (hit, value, future, generation). ``generation`` is None when
+        another caller is already computing the key and ``future`` should be awaited."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1], None, None
+            if entry is not None:
+                del self._entries[key]
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return False, None, future, None
+
+            self.misses += 1
+            future = self._in_flight[key] = Future()
+            return False, None, future, self._generation
+
+    def _store(self, key, value, future, generation):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        future.set_result(value)
+
+    def _fail(self, key, future, error):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        future.set_exception(error)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
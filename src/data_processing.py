@@ -1,17 +1,31 @@
 # src/data_processing.py
 import os
+import time
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import torch
 from torch_geometric.data import HeteroData
+from .artifacts import (
+    PLAYLIST_MAPPING_NAME, SONG_MAPPING_NAME,
+    append_song_metadata, build_playlist_index, build_sorted_mapping, extend_playlist_index,
+    load_mappings, load_playlist_index, save_graph_id, save_mapping, save_playlist_index, save_song_metadata
+)
+from .fallback import build_fallback, save_fallback, update_fallback
 
-def create_graph_data(base_path, features_path, output_dir='artifacts'):
-    """Processes raw data and creates the graph object and mappings."""
-    print("Starting data processing...")
-    
-    # --- Load and process JSON files ---
-    json_files = [f for f in os.listdir(base_path) if f.endswith('.json')]
+FEATURE_COLS = ['danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
+                'instrumentalness', 'liveness', 'valence', 'tempo', 'popularity']
+MANIFEST_FILE = 'ingested_files.json'
+FEATURE_STATS_FILE = 'feature_stats.json'
+BUILD_REPORT_FILE = 'graph_build_report.json'
+# Intermediate parse shards; a work directory, not an artifact (not synced or served)
+DEFAULT_SHARD_DIR = os.path.join('work', 'shards')
+
+def _load_slices_pandas(base_path, json_files):
+    """Original ingestion: normalizes every slice in-process and concatenates the results."""
     all_dfs = []
     for file_name in tqdm(json_files, desc="Processing JSON files"):
         file_path = os.path.join(base_path, file_name)
@@ -30,52 +44,420 @@ def create_graph_data(base_path, features_path, output_dir='artifacts'):
             all_dfs.append(temp_df)
 
     final_df = pd.concat(all_dfs, ignore_index=True)
+    final_df['track_uri'] = final_df['track_uri'].str.split(':').str[-1]
+    return final_df
+
+def _source_stamp(file_path):
+    """(size, mtime in ns) of a slice, recorded in its shard to detect changed input."""
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+def _shard_is_current(file_path, shard_path):
+    """True if ``shard_path`` exists and was parsed from the current ``file_path``."""
+    if not os.path.exists(shard_path):
+        return False
+    with np.load(shard_path) as shard:
+        if 'source_size' not in shard.files:  # Shards written before stamps were recorded
+            return False
+        stamp = int(shard['source_size']), int(shard['source_mtime_ns'])
+    return stamp == _source_stamp(file_path)
+
+def _parse_slice_to_shard(file_path, shard_path):
+    """Worker: reads the graph fields of one MPD slice and writes them as a compact shard.
+
+    The shard holds one int64 pid and one int32 track code per interaction, plus
+    the slice-local track dictionary (URI and name per code), playlist names and
+    the size/mtime of the slice it was parsed from.
+    """
+    source_size, source_mtime_ns = _source_stamp(file_path)
+    with open(file_path, 'r') as f:
+        data = json.load(f)
+
+    pids, uris = [], []
+    track_names = {}
+    playlist_pids, playlist_names = [], []
+    for playlist in data['playlists']:
+        playlist_pids.append(playlist['pid'])
+        playlist_names.append(playlist.get('name', ''))
+        for track in playlist.get('tracks', []):
+            uri = track['track_uri'].split(':')[-1]
+            pids.append(playlist['pid'])
+            uris.append(uri)
+            track_names.setdefault(uri, track.get('track_name', ''))
+
+    codes, categories = pd.factorize(pd.Series(uris, dtype=object))
+    # Write under a temporary name so a killed worker never leaves a truncated shard behind
+    tmp_path = f'{shard_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(
+            f,
+            pid=np.asarray(pids, dtype=np.int64),
+            track_code=codes.astype(np.int32),
+            track_uri=np.asarray(categories, dtype=str),
+            track_name=np.asarray([track_names[uri] for uri in categories], dtype=str),
+            playlist_pid=np.asarray(playlist_pids, dtype=np.int64),
+            playlist_name=np.asarray(playlist_names, dtype=str),
+            source_size=np.int64(source_size),
+            source_mtime_ns=np.int64(source_mtime_ns),
+        )
+    os.replace(tmp_path, shard_path)
+    return shard_path
+
+def _load_slices_streaming(base_path, json_files, shard_dir, num_workers=None):
+    """Parses slices in a process pool into on-disk shards, then merges the shards.
+
+    Each worker only ever holds one slice, and the merge keeps integer codes plus
+    one copy of each distinct URI/name: the string columns are returned as
+    categoricals, so each interaction costs a pid and a few integer codes
+    rather than parsed JSON or per-row strings. Shards parsed from the current
+    version of their slice (same size and mtime) are reused, so an interrupted
+    run resumes where it stopped; shards of changed slices are parsed again.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_paths = [os.path.join(shard_dir, os.path.splitext(f)[0] + '.npz') for f in json_files]
+    pending = [(os.path.join(base_path, f), shard) for f, shard in zip(json_files, shard_paths)
+               if not _shard_is_current(os.path.join(base_path, f), shard)]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_parse_slice_to_shard, file_path, shard) for file_path, shard in pending]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Parsing JSON slices"):
+            future.result()
+
+    # --- Merge shards into one global track dictionary ---
+    uri_to_code = {}
+    track_uris, track_names = [], []
+    pid_chunks, code_chunks = [], []
+    playlist_names = {}
+    for shard_path in tqdm(shard_paths, desc="Merging shards"):
+        with np.load(shard_path) as shard:
+            shard_uris = shard['track_uri'].tolist()
+            local_to_global = np.empty(len(shard_uris), dtype=np.int32)
+            for i, (uri, name) in enumerate(zip(shard_uris, shard['track_name'].tolist())):
+                code = uri_to_code.get(uri)
+                if code is None:
+                    code = uri_to_code[uri] = len(track_uris)
+                    track_uris.append(uri)
+                    track_names.append(name)
+                local_to_global[i] = code
+            pid_chunks.append(shard['pid'])
+            code_chunks.append(local_to_global[shard['track_code']])
+            playlist_names.update(zip(shard['playlist_pid'].tolist(), shard['playlist_name'].tolist()))
+
+    pids = np.concatenate(pid_chunks)
+    codes = np.concatenate(code_chunks)
+    # Categoricals over the distinct values, so no string is materialized per interaction
+    unique_pids, pid_codes = np.unique(pids, return_inverse=True)
+    name_codes, names = pd.factorize(pd.Series([playlist_names[pid] for pid in unique_pids.tolist()], dtype=object))
+    track_name_codes, unique_track_names = pd.factorize(pd.Series(track_names, dtype=object))
+    return pd.DataFrame({
+        'pid': pids,
+        'name': pd.Categorical.from_codes(name_codes[pid_codes], names),
+        'track_uri': pd.Categorical.from_codes(codes, pd.Index(track_uris, dtype=object)),
+        'track_name': pd.Categorical.from_codes(track_name_codes[codes], unique_track_names),
+    })
 
+def _list_json_files(base_path):
+    # Hidden files (e.g. the S3 sync's .sync_manifest.json) are not MPD slices
+    return sorted(f for f in os.listdir(base_path) if f.endswith('.json') and not f.startswith('.'))
+
+def _load_manifest(output_dir):
+    """Returns the set of JSON slice names already ingested into the artifacts."""
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(
+            f"No {MANIFEST_FILE} in {output_dir}. Run a full `python main.py --stage process` first."
+        )
+    with open(manifest_path, 'r') as f:
+        return set(json.load(f)['files'])
+
+def _save_manifest(output_dir, json_files):
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as f:
+        json.dump({'files': list(json_files)}, f)
+
+def _enrich_and_clean(final_df, features_path):
+    """Joins the track features onto the distinct tracks and drops incomplete rows.
+
+    The features are merged once per track, not per interaction. Returns
+    (interactions_df, tracks_df), where the interactions' ``track_uri`` is a
+    categorical whose categories are ``tracks_df['track_uri']`` in row order, so
+    its codes are row positions in ``tracks_df``.
+    """
     # --- Merge with Features ---
-    final_df['track_uri'] = final_df['track_uri'].str.split(':').str[-1]
     track_features_df = pd.read_csv(features_path)
-    enriched_df = pd.merge(final_df, track_features_df, left_on='track_uri', right_on='track_id', how='left')
-    
+    tracks_df = final_df[['track_uri', 'track_name']].drop_duplicates(subset='track_uri').astype(object)
+    tracks_df = pd.merge(tracks_df, track_features_df, left_on='track_uri', right_on='track_id', how='left')
+
     # --- Clean Data ---
-    cleaned_df = enriched_df.dropna()
-    print(f"Data cleaned. Final number of interactions: {len(cleaned_df)}")
+    # A track listed with several feature rows keeps its first complete one
+    tracks_df = tracks_df.dropna().drop_duplicates(subset='track_uri').reset_index(drop=True)
+    interactions_df = final_df.drop(columns='track_name').dropna()
+    track_uris = interactions_df['track_uri'].astype(pd.CategoricalDtype(tracks_df['track_uri']))
+    interactions_df = interactions_df.assign(track_uri=track_uris)[track_uris.notna().to_numpy()]
+
+    # Keep only the tracks that still have interactions, in the same order as the categories
+    used = np.zeros(len(tracks_df), dtype=bool)
+    used[interactions_df['track_uri'].cat.codes.to_numpy()] = True
+    tracks_df = tracks_df[used].reset_index(drop=True)
+    interactions_df['track_uri'] = interactions_df['track_uri'].cat.remove_unused_categories()
+    print(f"Data cleaned. Final number of interactions: {len(interactions_df)} ({len(tracks_df)} tracks)")
+    return interactions_df, tracks_df
+
+def _write_cleaned_csv(interactions_df, tracks_df, csv_path, columns=None, chunk_size=1_000_000):
+    """Writes the interactions joined with their track rows, ``chunk_size`` rows at a time
+    so the joined table never exists in full. With ``columns``, appends to an existing
+    CSV with that header instead of overwriting it."""
+    track_rows = interactions_df['track_uri'].cat.codes.to_numpy()
+    interaction_cols = interactions_df.drop(columns='track_uri')
+    # Columns present on both sides are suffixed like a merge would
+    overlap = interaction_cols.columns.intersection(tracks_df.columns)
+    interaction_cols = interaction_cols.rename(columns={col: f'{col}_x' for col in overlap})
+    track_cols = tracks_df.rename(columns={col: f'{col}_y' for col in overlap})
+    for start in range(0, len(interactions_df), chunk_size):
+        chunk = pd.concat([
+            interaction_cols.iloc[start:start + chunk_size].reset_index(drop=True),
+            track_cols.iloc[track_rows[start:start + chunk_size]].reset_index(drop=True)
+        ], axis=1)
+        if columns is None:
+            chunk.to_csv(csv_path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+        else:
+            chunk.reindex(columns=columns).to_csv(csv_path, mode='a', header=False, index=False)
+
+def _memory_mb():
+    """Returns (current RSS, peak RSS) of this process in MB, or (None, None) off Linux."""
+    rss = peak = None
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return rss, peak
+
+class _StepReport:
+    """Records the wall time and process memory after each step of a build."""
+    def __init__(self):
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        rss, peak = _memory_mb()
+        self.steps.append({'step': name, 'seconds': seconds, 'rss_mb': rss, 'peak_rss_mb': peak})
+        memory = f", RSS {rss:.0f} MB (peak {peak:.0f} MB)" if rss is not None else ""
+        print(f"  [{name}] {seconds:.2f}s{memory}")
+
+    def save(self, output_dir):
+        with open(os.path.join(output_dir, BUILD_REPORT_FILE), 'w') as f:
+            json.dump({'steps': self.steps}, f, indent=2)
+
+def _dedupe_edges(song_indices, playlist_indices, num_songs):
+    """Returns a mask keeping the first occurrence of each (playlist, song) pair."""
+    keys = playlist_indices.astype(np.int64) * num_songs + song_indices
+    _, first = np.unique(keys, return_index=True)
+    keep = np.zeros(len(keys), dtype=bool)
+    keep[first] = True
+    return keep
+
+def _build_edge_index(song_indices, playlist_indices):
+    """Packs the endpoints into one contiguous [2, E] int64 array and wraps it without a copy."""
+    edges = np.empty((2, len(song_indices)), dtype=np.int64)
+    edges[0] = song_indices
+    edges[1] = playlist_indices
+    return torch.from_numpy(edges)
+
+def _save_feature_stats(output_dir, mean, std):
+    with open(os.path.join(output_dir, FEATURE_STATS_FILE), 'w') as f:
+        json.dump({'columns': FEATURE_COLS, 'mean': mean.tolist(), 'std': std.tolist()}, f)
+
+def _load_feature_stats(output_dir):
+    """Returns the (mean, std) used to standardize the saved features, or None for raw features."""
+    path = os.path.join(output_dir, FEATURE_STATS_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        stats = json.load(f)
+    return np.asarray(stats['mean']), np.asarray(stats['std'])
+
+def create_graph_data(base_path, features_path, output_dir='artifacts', ingest='stream', num_workers=None,
+                      shard_dir=DEFAULT_SHARD_DIR):
+    """Processes raw data and creates the graph object and mappings.
+
+    ``ingest='stream'`` parses the JSON slices in a pool of ``num_workers``
+    processes (default: all cores) through on-disk shards in ``shard_dir``,
+    which is kept outside ``output_dir`` so the intermediate shards are never
+    synced or served as artifacts; ``ingest='pandas'`` is the original
+    single-process json_normalize path.
+    """
+    print("Starting data processing...")
+    
+    # --- Load and process JSON files ---
+    json_files = _list_json_files(base_path)
+    if ingest == 'stream':
+        final_df = _load_slices_streaming(base_path, json_files, shard_dir, num_workers)
+    elif ingest == 'pandas':
+        final_df = _load_slices_pandas(base_path, json_files)
+    else:
+        raise ValueError(f"Unknown ingest mode '{ingest}'. Choose 'stream' or 'pandas'.")
+
+    interactions_df, tracks_df = _enrich_and_clean(final_df, features_path)
+    del final_df
 
     # --- Build Graph ---
     print("Starting graph construction...")
-    unique_track_uris = cleaned_df['track_uri'].unique()
-    unique_pids = cleaned_df['pid'].unique()
+    report = _StepReport()
+    with report.step('factorize ids'):
+        # Codes follow first appearance, so song i is tracks_df row track_rows[i]
+        song_codes, track_rows = pd.factorize(interactions_df['track_uri'].cat.codes.to_numpy())
+        unique_track_uris = tracks_df['track_uri'].to_numpy(dtype=object)[track_rows]
+        playlist_codes, unique_pids = pd.factorize(interactions_df['pid'])
+        song_codes = song_codes.astype(np.int64, copy=False)
+        playlist_codes = playlist_codes.astype(np.int64, copy=False)
+        num_songs, num_playlists = len(unique_track_uris), len(unique_pids)
+
+    with report.step('dedupe edges'):
+        # A track listed twice in a playlist is one edge
+        keep = _dedupe_edges(song_codes, playlist_codes, num_songs)
+        song_indices, playlist_indices = song_codes[keep], playlist_codes[keep]
+        print(f"  Dropped {len(keep) - len(song_indices)} repeated playlist-track edges.")
+
+    with report.step('song features'):
+        # Track rows in song-index order, so features and metadata line up with the mapping
+        song_metadata_df = tracks_df.iloc[track_rows]
+        raw_features = song_metadata_df[FEATURE_COLS].to_numpy(dtype=np.float64)
+        # Standardize so tempo/loudness/popularity don't dominate the unit-scale features
+        feature_mean = raw_features.mean(axis=0)
+        feature_std = raw_features.std(axis=0)
+        feature_std[feature_std == 0] = 1.0
+        song_features = ((raw_features - feature_mean) / feature_std).astype(np.float32)
+
+    with report.step('edge index'):
+        edge_index = _build_edge_index(song_indices, playlist_indices)
+        data = HeteroData()
+        data['song'].x = torch.from_numpy(song_features)
+        data['playlist'].num_nodes = num_playlists
+        data['song', 'belongs_to', 'playlist'].edge_index = edge_index
+        data['playlist', 'contains', 'song'].edge_index = edge_index.flip([0])
+
+    with report.step('playlist index'):
+        # Per-playlist song lists, so inference can mask seen songs without a DataFrame scan
+        playlist_index = build_playlist_index(song_indices, playlist_indices, num_playlists)
+
+    with report.step('fallback tables'):
+        # Popularity and co-occurrence tables the API serves from when the GNN can't answer
+        fallback = build_fallback(playlist_index, num_songs)
+
+    # --- Save Artifacts ---
+    os.makedirs(output_dir, exist_ok=True)
+    with report.step('save artifacts'):
+        torch.save(data, os.path.join(output_dir, 'graph_data.pt'))
+        save_playlist_index(playlist_index, output_dir)
+        save_song_metadata(song_metadata_df, output_dir)
+        save_mapping(build_sorted_mapping(np.asarray(unique_track_uris, dtype=object)), output_dir, SONG_MAPPING_NAME)
+        save_mapping(build_sorted_mapping(np.asarray(unique_pids)), output_dir, PLAYLIST_MAPPING_NAME)
+        _save_feature_stats(output_dir, feature_mean, feature_std)
+        save_fallback(*fallback, output_dir)
+        _save_manifest(output_dir, json_files)
+        # Marks embeddings exported from the previous graph as stale
+        save_graph_id(output_dir)
+
+    with report.step('save cleaned csv'):
+        # Save a copy of cleaned data for analysis (inference reads the compact artifacts above)
+        _write_cleaned_csv(interactions_df, tracks_df, os.path.join(output_dir, 'cleaned_playlists_and_tracks.csv'))
+    report.save(output_dir)
 
-    song_mapping = {uri: i for i, uri in enumerate(unique_track_uris)}
-    playlist_mapping = {int(pid): i for i, pid in enumerate(unique_pids)}
+    print(f"Graph with {num_songs} songs, {num_playlists} playlists and {len(song_indices)} edges "
+          f"saved to {output_dir}/ (step timings in {BUILD_REPORT_FILE}).")
 
-    unique_songs_df = cleaned_df.drop_duplicates(subset='track_uri').sort_values('track_uri')
-    feature_cols = ['danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
-                    'instrumentalness', 'liveness', 'valence', 'tempo', 'popularity']
-    song_features = unique_songs_df[feature_cols].to_numpy()
-    song_features_tensor = torch.tensor(song_features, dtype=torch.float32)
+def update_graph_data(base_path, features_path, output_dir='artifacts', num_workers=None, shard_dir=DEFAULT_SHARD_DIR):
+    """Incrementally adds JSON slices that are not yet in the manifest to the saved graph.
 
-    song_indices = cleaned_df['track_uri'].map(song_mapping).to_numpy()
-    playlist_indices = cleaned_df['pid'].map(playlist_mapping).to_numpy()
-    edge_index = torch.tensor([song_indices, playlist_indices], dtype=torch.long)
+    Existing song and playlist indices never change: new songs and playlists are
+    appended after the current ones, their edges are added to the saved
+    HeteroData, and the playlist index, song metadata, mappings and manifest are
+    extended in place. Work is proportional to the new slices, apart from
+    rewriting the artifact files. The model must be retrained (and embeddings
+    re-exported) before new playlists can be served.
+    """
+    ingested = _load_manifest(output_dir)
+    new_files = [f for f in _list_json_files(base_path) if f not in ingested]
+    if not new_files:
+        print("No new JSON slices to ingest; artifacts are up to date.")
+        return
+    print(f"Found {len(new_files)} new JSON slices ({len(ingested)} already ingested).")
 
-    data = HeteroData()
-    data['song'].x = song_features_tensor
-    data['playlist'].num_nodes = len(unique_pids)
+    final_df = _load_slices_streaming(base_path, new_files, shard_dir, num_workers)
+    interactions_df, tracks_df = _enrich_and_clean(final_df, features_path)
+    del final_df
+
+    # --- Extend the mappings, keeping every existing index ---
+    old_song_mapping, old_playlist_mapping = load_mappings(output_dir)
+    num_old_songs = len(old_song_mapping)
+
+    track_uris = tracks_df['track_uri'].to_numpy(dtype=object)
+    new_songs_df = tracks_df[old_song_mapping.lookup(track_uris) < 0]
+    unique_pids = interactions_df['pid'].unique()
+    new_pids = unique_pids[old_playlist_mapping.lookup(unique_pids) < 0]
+
+    # New keys get the next indices; the merged mappings are rebuilt in memory, then saved
+    song_mapping = build_sorted_mapping(
+        np.concatenate([old_song_mapping.ordered_keys().astype(object), new_songs_df['track_uri'].to_numpy(dtype=object)])
+    )
+    playlist_mapping = build_sorted_mapping(np.concatenate([old_playlist_mapping.ordered_keys(), new_pids.astype(np.int64)]))
+
+    song_indices = song_mapping.lookup(track_uris)[interactions_df['track_uri'].cat.codes.to_numpy()]
+    playlist_indices = playlist_mapping.lookup(interactions_df['pid'].to_numpy())
+    num_songs = len(song_mapping)
+
+    # --- Drop edges repeated within the new slices or already in the graph ---
+    playlist_index = load_playlist_index(output_dir, mmap_mode=None)
+    keep = _dedupe_edges(song_indices, playlist_indices, num_songs)
+    old_playlists = np.unique(playlist_indices[playlist_indices < playlist_index.num_playlists])
+    rows, cols = playlist_index.seen_pairs(old_playlists)
+    keep &= ~np.isin(playlist_indices * num_songs + song_indices, old_playlists[rows] * num_songs + cols)
+    song_indices, playlist_indices = song_indices[keep], playlist_indices[keep]
+
+    # --- Extend the graph ---
+    data = torch.load(os.path.join(output_dir, 'graph_data.pt'), weights_only=False)
+    new_features = new_songs_df[FEATURE_COLS].to_numpy(dtype=np.float64)
+    # New songs are scaled with the statistics of the original build, so existing rows stay valid
+    feature_stats = _load_feature_stats(output_dir)
+    if feature_stats is not None:
+        new_features = (new_features - feature_stats[0]) / feature_stats[1]
+    data['song'].x = torch.cat([data['song'].x, torch.from_numpy(new_features.astype(np.float32))])
+    data['playlist'].num_nodes = len(playlist_mapping)
+
+    delta_edges = _build_edge_index(song_indices, playlist_indices)
+    edge_index = torch.cat([data['song', 'belongs_to', 'playlist'].edge_index, delta_edges], dim=1)
     data['song', 'belongs_to', 'playlist'].edge_index = edge_index
     data['playlist', 'contains', 'song'].edge_index = edge_index.flip([0])
-    
+
+    playlist_index = extend_playlist_index(playlist_index, song_indices, playlist_indices, len(playlist_mapping))
+
     # --- Save Artifacts ---
-    os.makedirs(output_dir, exist_ok=True)
     torch.save(data, os.path.join(output_dir, 'graph_data.pt'))
-    with open(os.path.join(output_dir, 'song_mapping.json'), 'w') as f:
-        json.dump(song_mapping, f)
-    with open(os.path.join(output_dir, 'playlist_mapping.json'), 'w') as f:
-        json.dump(playlist_mapping, f)
-    
-    # Save a copy of cleaned data for inference step
-    cleaned_df.to_csv(os.path.join(output_dir, 'cleaned_playlists_and_tracks.csv'), index=False)
-    
-    print("Graph and mappings saved successfully to artifacts/ directory.")
+    save_playlist_index(playlist_index, output_dir)
+    # Only songs in playlists that gained edges get new co-occurrence rows
+    save_fallback(*update_fallback(playlist_index, num_songs, playlist_indices, output_dir), output_dir)
+    append_song_metadata(new_songs_df, output_dir)
+    del old_song_mapping, old_playlist_mapping  # Release the memory maps before overwriting
+    save_mapping(song_mapping, output_dir, SONG_MAPPING_NAME)
+    save_mapping(playlist_mapping, output_dir, PLAYLIST_MAPPING_NAME)
+    _save_manifest(output_dir, sorted(ingested | set(new_files)))
+    save_graph_id(output_dir)
+
+    csv_path = os.path.join(output_dir, 'cleaned_playlists_and_tracks.csv')
+    if os.path.exists(csv_path):
+        columns = pd.read_csv(csv_path, nrows=0).columns
+        _write_cleaned_csv(interactions_df, tracks_df, csv_path, columns=columns)
+
+    print(f"Added {len(song_mapping) - num_old_songs} songs, {len(song_indices)} interactions; "
+          f"graph now has {len(song_mapping)} songs and {len(playlist_mapping)} playlists.")
+    print("Retrain the model and re-run --stage export to serve the new playlists.")
 
 if __name__ == '__main__':
     # Example paths for running directly
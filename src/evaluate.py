@@ -0,0 +1,211 @@
+# src/evaluate.py
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from .artifacts import HOLDOUT_EDGES_FILE, build_playlist_index
+from .inference import Recommender
+
+EVALUATION_FILE = 'evaluation.json'
+
+def holdout_split(playlist_index, playlist_indices, holdout_fraction=0.2, seed=0):
+    """Randomly splits the songs of each playlist into visible and held-out songs.
+
+    Returns (kept_rows, kept_cols, held_rows, held_cols), where rows are positions
+    in ``playlist_indices``. At least one song per playlist is held out, and at
+    least one kept when the playlist has two or more songs.
+    """
+    rows, cols = playlist_index.seen_pairs(playlist_indices)
+    rng = np.random.default_rng(seed)
+    # Shuffle the songs within each playlist, keeping the rows grouped
+    order = np.lexsort((rng.random(len(rows)), rows))
+    rows, cols = rows[order], cols[order]
+
+    lengths = np.bincount(rows, minlength=len(playlist_indices))
+    num_held = np.clip((lengths * holdout_fraction).astype(np.int64), 1, np.maximum(lengths - 1, 1))
+    starts = np.cumsum(lengths) - lengths
+    held = np.arange(len(rows)) - starts[rows] < num_held[rows]
+    return rows[~held], cols[~held], rows[held], cols[held]
+
+def evaluate_chunk(recommender, playlist_indices, ks, holdout_fraction=0.2, query='seed', seed=0,
+                   held_index=None):
+    """Scores one chunk of playlists with their held-out songs unmasked.
+
+    With ``held_index`` (the playlist -> held-out songs index of the training
+    split) those songs are the held-out ones and the recommender's playlist index
+    holds the visible ones; otherwise ``holdout_split`` picks them at random.
+
+    Returns (num_playlists, {k: {'recall_sum', 'ndcg_sum', 'songs'}}), where
+    ``songs`` are the distinct songs recommended in the top k (for coverage).
+    """
+    if held_index is not None:
+        kept_rows, kept_cols = recommender.playlist_index.seen_pairs(playlist_indices)
+        held_rows, held_cols = held_index.seen_pairs(playlist_indices)
+    else:
+        kept_rows, kept_cols, held_rows, held_cols = holdout_split(
+            recommender.playlist_index, playlist_indices, holdout_fraction, seed
+        )
+    num_playlists = len(playlist_indices)
+    device = recommender.device
+    seen_rows = torch.from_numpy(kept_rows).to(device)
+    seen_cols = torch.from_numpy(kept_cols).to(device)
+    if query == 'seed':
+        # Embed each playlist from its visible songs only, as for a playlist unseen in training
+        queries = recommender.seed_encoder.encode_many(seen_cols, seen_rows, num_playlists)
+    else:
+        queries = recommender.final_embeddings['playlist'][torch.as_tensor(playlist_indices, device=device)]
+
+    # Only the visible songs are masked, so held-out songs can be retrieved
+    _, top = recommender.retriever.search(queries, max(ks), seen_rows, seen_cols)
+    top = top.cpu().numpy()
+
+    num_songs = recommender.retriever.num_songs
+    row_keys = np.arange(num_playlists, dtype=np.int64)[:, None] * num_songs
+    hits = np.isin(row_keys + top, held_rows * num_songs + held_cols) & (top >= 0)
+    num_held = np.bincount(held_rows, minlength=num_playlists)
+    discounts = 1.0 / np.log2(np.arange(2, top.shape[1] + 2))
+
+    results = {}
+    for k in ks:
+        k_hits = hits[:, :k]
+        dcg = (k_hits * discounts[:k]).sum(axis=1)
+        ideal_dcg = np.cumsum(discounts[:k])[np.minimum(num_held, k_hits.shape[1]) - 1]
+        k_top = top[:, :k]
+        results[k] = {
+            'recall_sum': float((k_hits.sum(axis=1) / num_held).sum()),
+            'ndcg_sum': float((dcg / ideal_dcg).sum()),
+            'songs': np.unique(k_top[k_top >= 0]),
+        }
+    return num_playlists, results
+
+def _load_recommender(artifact_dir, retrieval, holdout):
+    """Returns (recommender, held_index); held_index is None for random hold-out."""
+    if holdout == 'random':
+        return Recommender(artifact_dir=artifact_dir, retrieval=retrieval), None
+    held_edges = np.load(os.path.join(artifact_dir, HOLDOUT_EDGES_FILE))
+    recommender = Recommender(artifact_dir=artifact_dir, retrieval=retrieval, mode='graph', drop_edges=held_edges)
+    held_index = build_playlist_index(held_edges[0], held_edges[1], len(recommender.playlist_mapping))
+    return recommender, held_index
+
+_worker_recommender = None
+_worker_held_index = None
+
+def _init_worker(artifact_dir, retrieval, holdout, num_threads):
+    global _worker_recommender, _worker_held_index
+    torch.set_num_threads(num_threads)
+    _worker_recommender, _worker_held_index = _load_recommender(artifact_dir, retrieval, holdout)
+
+def _evaluate_chunk_in_worker(args):
+    return evaluate_chunk(_worker_recommender, *args, held_index=_worker_held_index)
+
+def evaluate_recommender(artifact_dir='artifacts', ks=(10, 100), num_playlists=None, holdout_fraction=0.2,
+                         min_tracks=5, query='seed', retrieval='exact', chunk_size=256, num_workers=1, seed=0,
+                         holdout='training'):
+    """Offline ranking evaluation: recall@k, NDCG@k and catalogue coverage.
+
+    Some songs of every playlist with at least ``min_tracks`` songs (or a sample
+    of ``num_playlists`` of them) are hidden; the remaining songs are masked like
+    the API does and the top-k is compared with the hidden ones.
+
+    ``holdout='training'`` hides the test split that ``train_model`` held out
+    (``holdout_edges.npy``): the model never trained on those pairs, and the
+    embeddings are recomputed from the graph without them (graph mode, exact
+    retrieval), so neither query type has seen them. ``holdout='random'`` hides
+    ``holdout_fraction`` of each playlist's songs at random from the served
+    embeddings; those pairs were in the training graph and reached the song
+    embeddings and playlist embeddings alike, so its metrics are optimistic.
+    ``query='seed'`` embeds each playlist from its visible songs with the
+    seed-track encoder; ``query='embedding'`` uses the trained playlist embedding.
+
+    Playlists are scored ``chunk_size`` at a time through the retrieval backend,
+    optionally in ``num_workers`` processes that each load the recommender
+    (memory-mapped exported embeddings share their pages; with
+    ``holdout='training'`` every worker runs its own forward pass). Results are
+    printed and written to ``evaluation.json``.
+    """
+    if holdout == 'training':
+        if not os.path.exists(os.path.join(artifact_dir, HOLDOUT_EDGES_FILE)):
+            raise FileNotFoundError(f"{HOLDOUT_EDGES_FILE} not found in {artifact_dir}; re-run --stage train, "
+                                    f"or evaluate with holdout='random' (optimistic metrics).")
+        if retrieval != 'exact':
+            raise ValueError("holdout='training' recomputes the embeddings and only supports exact retrieval.")
+    elif holdout == 'random':
+        print("WARNING: randomly held-out songs were part of the training graph; the metrics are optimistic.")
+    else:
+        raise ValueError(f"Unknown holdout '{holdout}'. Choose 'training' or 'random'.")
+
+    recommender, held_index = _load_recommender(artifact_dir, retrieval, holdout)
+    if query == 'seed' and recommender.seed_encoder is None:
+        raise ValueError("query='seed' needs the seed-track encoder inputs; re-run --stage export "
+                         "or evaluate with query='embedding'.")
+    ks = sorted(ks)
+    num_songs = recommender.retriever.num_songs
+
+    visible = np.diff(np.asarray(recommender.playlist_index.indptr))
+    if held_index is not None:
+        hidden = np.diff(np.asarray(held_index.indptr))
+        playlists = np.nonzero((visible + hidden >= max(min_tracks, 2)) & (visible > 0) & (hidden > 0))[0]
+    else:
+        playlists = np.nonzero(visible >= max(min_tracks, 2))[0]
+    if num_playlists is not None and num_playlists < len(playlists):
+        playlists = np.sort(np.random.default_rng(seed).choice(playlists, num_playlists, replace=False))
+    # Each chunk gets its own seed, so results don't depend on how chunks are spread over workers
+    tasks = [(playlists[i:i + chunk_size], ks, holdout_fraction, query, seed + i)
+             for i in range(0, len(playlists), chunk_size)]
+    held_out = 'training split held out' if held_index is not None else f"{holdout_fraction:.0%} of songs held out"
+    print(f"Evaluating {len(playlists)} playlists ({held_out}, "
+          f"{query} queries, {retrieval} retrieval) in {len(tasks)} chunks...")
+
+    totals = {k: {'recall_sum': 0.0, 'ndcg_sum': 0.0, 'songs': set()} for k in ks}
+    evaluated = 0
+    start = time.perf_counter()
+
+    def accumulate(outputs):
+        nonlocal evaluated
+        for chunk_playlists, results in tqdm(outputs, total=len(tasks), desc="Scoring playlists"):
+            evaluated += chunk_playlists
+            for k, result in results.items():
+                totals[k]['recall_sum'] += result['recall_sum']
+                totals[k]['ndcg_sum'] += result['ndcg_sum']
+                totals[k]['songs'].update(result['songs'].tolist())
+
+    if num_workers > 1:
+        del recommender  # Each worker loads its own
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        # Spawned, not forked, because the parent has already started torch's thread pool
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(artifact_dir, retrieval, holdout, num_threads)) as executor:
+            accumulate(executor.map(_evaluate_chunk_in_worker, tasks))
+    else:
+        accumulate(evaluate_chunk(recommender, *task, held_index=held_index) for task in tasks)
+    seconds = time.perf_counter() - start
+
+    metrics = {
+        'playlists': evaluated,
+        'holdout': holdout,
+        'holdout_fraction': holdout_fraction if holdout == 'random' else None,
+        'query': query,
+        'retrieval': retrieval,
+        'seconds': seconds,
+        'metrics': {
+            str(k): {
+                'recall': totals[k]['recall_sum'] / max(evaluated, 1),
+                'ndcg': totals[k]['ndcg_sum'] / max(evaluated, 1),
+                'coverage': len(totals[k]['songs']) / num_songs,
+            } for k in ks
+        },
+    }
+
+    print(f"\n--- Ranking metrics over {evaluated} playlists ({seconds:.1f}s) ---")
+    for k, values in metrics['metrics'].items():
+        print(f"k={k:>4}  recall={values['recall']:.4f}  ndcg={values['ndcg']:.4f}  coverage={values['coverage']:.4f}")
+    with open(os.path.join(artifact_dir, EVALUATION_FILE), 'w') as f:
+        json.dump(metrics, f, indent=2)
+    print(f"Results written to {os.path.join(artifact_dir, EVALUATION_FILE)}.")
+    return metrics
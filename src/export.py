@@ -0,0 +1,28 @@
+# src/export.py
+import os
+from .artifacts import (
+    PLAYLIST_EMBEDDINGS_FILE, SONG_EMBEDDINGS_FILE, SONG_FEATURES_FILE, SONG_HIDDEN_FILE,
+    file_sha256, load_graph_id, save_embedding_matrix
+)
+from .inference import MODEL_WEIGHTS_FILE, Recommender
+
+def export_embeddings(artifact_dir='artifacts'):
+    """Runs the trained GNN once over the full graph and writes the final
+    embeddings, so the API can memory-map them instead of running the model."""
+    recommender = Recommender(artifact_dir=artifact_dir, mode='graph')
+    # Recorded in every file, so the API can tell when the export is older than the graph or weights
+    stamps = dict(graph_id=load_graph_id(artifact_dir),
+                  weights_sha256=file_sha256(os.path.join(artifact_dir, MODEL_WEIGHTS_FILE)))
+
+    for node_type, file_name in (('song', SONG_EMBEDDINGS_FILE), ('playlist', PLAYLIST_EMBEDDINGS_FILE)):
+        embeddings = recommender.final_embeddings[node_type].cpu().numpy()
+        save_embedding_matrix(embeddings, os.path.join(artifact_dir, file_name), **stamps)
+        print(f"Exported {node_type} embeddings {embeddings.shape} to {file_name}.")
+
+    # Inputs of the seed-track encoder, so unseen playlists can be embedded without the graph
+    for tensor, file_name in ((recommender.seed_encoder.song_features, SONG_FEATURES_FILE),
+                              (recommender.seed_encoder.song_hidden, SONG_HIDDEN_FILE)):
+        save_embedding_matrix(tensor.cpu().numpy(), os.path.join(artifact_dir, file_name), **stamps)
+        print(f"Exported {file_name} {tuple(tensor.shape)}.")
+
+    print("Embedding export complete. Re-run this stage after every training run.")
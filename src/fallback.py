@@ -0,0 +1,218 @@
+# src/fallback.py
+import os
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from .artifacts import (
+    SONG_METADATA_COLUMNS, PlaylistIndex, load_mappings, load_playlist_index, load_song_metadata
+)
+
+POPULAR_SONGS_FILE = 'popular_songs.npy'
+COOCCURRENCE_INDPTR_FILE = 'cooccurrence_indptr.npy'
+COOCCURRENCE_INDICES_FILE = 'cooccurrence_indices.npy'
+COOCCURRENCE_SCORES_FILE = 'cooccurrence_scores.npy'
+
+
+def _binary_matrix(playlist_index, num_songs):
+    """The playlist x song matrix A of ``playlist_index``, with a 1 per distinct pair."""
+    indptr, indices = np.asarray(playlist_index.indptr), np.asarray(playlist_index.indices)
+    matrix = sp.csr_matrix(
+        (np.ones(len(indices), dtype=np.float32), indices, indptr),
+        shape=(playlist_index.num_playlists, num_songs)
+    )
+    matrix.sum_duplicates()
+    matrix.data[:] = 1.0
+    return matrix
+
+
+def _chunk_bounds(cost, max_nnz):
+    """Splits rows into consecutive chunks whose total ``cost`` is at most ``max_nnz``;
+    a single row costing more gets a chunk of its own."""
+    cumulative = np.cumsum(cost)
+    bounds = [0]
+    while bounds[-1] < len(cost):
+        start = bounds[-1]
+        offset = cumulative[start - 1] if start else 0
+        end = int(np.searchsorted(cumulative, offset + max_nnz, side='right'))
+        bounds.append(max(end, start + 1))
+    return bounds
+
+
+def _cooccurrence_rows(matrix, songs, top_n, max_nnz):
+    """Top-``top_n`` co-occurring songs of each of ``songs`` (rows of A.T @ A, self excluded).
+
+    Returns (counts per song, neighbour indices, scores) in CSR order. Song
+    indices follow first appearance, so popular songs cluster together; chunks
+    are therefore cut by size rather than by song count: the product row of a
+    song has (before duplicates are summed) as many entries as its playlists
+    have songs in total, and each chunk is kept to about ``max_nnz`` of them.
+    """
+    by_song = matrix.T.tocsr()  # Columns as rows, so a chunk of songs is a cheap row selection
+    cost = by_song[songs] @ np.diff(matrix.indptr).astype(np.float64)
+    bounds = _chunk_bounds(cost, max_nnz)
+
+    chunk_counts, chunk_indices, chunk_scores = [], [], []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        chunk_songs = songs[start:end]
+        block = (by_song[chunk_songs] @ matrix).tocoo()
+        rows, cols, counts = block.row.astype(np.int64), block.col.astype(np.int64), block.data
+        not_self = cols != chunk_songs[rows]
+        rows, cols, counts = rows[not_self], cols[not_self], counts[not_self]
+
+        # Best ``top_n`` per row: sort by (row, -count) and keep each row's first entries
+        order = np.lexsort((-counts, rows))
+        rows, cols, counts = rows[order], cols[order], counts[order]
+        lengths = np.bincount(rows, minlength=len(chunk_songs))
+        row_starts = np.cumsum(lengths) - lengths
+        keep = np.arange(len(rows)) - row_starts[rows] < top_n
+        chunk_counts.append(np.minimum(lengths, top_n))
+        chunk_indices.append(cols[keep])
+        chunk_scores.append(counts[keep].astype(np.float32))
+
+    if not chunk_counts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunk_counts), np.concatenate(chunk_indices), np.concatenate(chunk_scores)
+
+
+def _popular_songs(playlist_index, num_songs):
+    """Song indices by descending number of playlists containing them."""
+    popularity = np.bincount(np.asarray(playlist_index.indices), minlength=num_songs)
+    return np.argsort(-popularity, kind='stable')
+
+
+def build_fallback(playlist_index, num_songs, top_n=50, max_nnz=10_000_000):
+    """Computes the popularity ranking and the top-``top_n`` co-occurring songs of every song.
+
+    With A the binary playlist x song matrix, popularity is A's column sums and
+    co-occurrence counts are A.T @ A, computed in chunks of songs whose product
+    has about ``max_nnz`` entries, so only one chunk of the (sparse) product
+    exists at once. Returns (popular_songs, co-occurrence PlaylistIndex-style
+    CSR, scores).
+    """
+    matrix = _binary_matrix(playlist_index, num_songs)
+    counts, indices, scores = _cooccurrence_rows(matrix, np.arange(num_songs), top_n, max_nnz)
+    indptr = np.zeros(num_songs + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return _popular_songs(playlist_index, num_songs), PlaylistIndex(indptr, indices), scores
+
+
+def update_fallback(playlist_index, num_songs, touched_playlists, artifact_dir, top_n=50, max_nnz=10_000_000):
+    """Updates the saved fallback tables after new edges were added to ``touched_playlists``.
+
+    Only songs in those playlists can gain co-occurrences, so only their rows
+    of A.T @ A are recomputed; every other row (and the rows of new songs
+    without edges) is carried over. Popularity is a single count over the
+    index. Falls back to a full build when there are no saved tables.
+    """
+    if not has_fallback(artifact_dir):
+        return build_fallback(playlist_index, num_songs, top_n, max_nnz)
+    # Loaded into memory, since the files are about to be overwritten
+    old_indptr = np.load(os.path.join(artifact_dir, COOCCURRENCE_INDPTR_FILE))
+    old_indices = np.load(os.path.join(artifact_dir, COOCCURRENCE_INDICES_FILE))
+    old_scores = np.load(os.path.join(artifact_dir, COOCCURRENCE_SCORES_FILE))
+
+    affected = np.unique(playlist_index.seen_pairs(np.unique(touched_playlists))[1])
+    matrix = _binary_matrix(playlist_index, num_songs)
+    new_counts, new_indices, new_scores = _cooccurrence_rows(matrix, affected, top_n, max_nnz)
+
+    # --- Splice the recomputed rows into the old table ---
+    num_old_songs = len(old_indptr) - 1
+    old_counts = np.diff(old_indptr)
+    counts = np.zeros(num_songs, dtype=np.int64)
+    counts[:num_old_songs] = old_counts
+    counts[affected] = new_counts
+    indptr = np.zeros(num_songs + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    scores = np.empty(indptr[-1], dtype=np.float32)
+
+    recomputed = np.zeros(num_songs, dtype=bool)
+    recomputed[affected] = True
+    old_rows = np.repeat(np.arange(num_old_songs), old_counts)
+    kept = ~recomputed[old_rows]
+    destinations = indptr[old_rows[kept]] + np.arange(len(old_indices))[kept] - old_indptr[old_rows[kept]]
+    indices[destinations] = old_indices[kept]
+    scores[destinations] = old_scores[kept]
+
+    new_rows = np.repeat(affected, new_counts)
+    rank_in_row = np.arange(len(new_indices)) - np.repeat(np.cumsum(new_counts) - new_counts, new_counts)
+    indices[indptr[new_rows] + rank_in_row] = new_indices
+    scores[indptr[new_rows] + rank_in_row] = new_scores
+    return _popular_songs(playlist_index, num_songs), PlaylistIndex(indptr, indices), scores
+
+
+def save_fallback(popular_songs, cooccurrence, scores, output_dir):
+    np.save(os.path.join(output_dir, POPULAR_SONGS_FILE), popular_songs)
+    np.save(os.path.join(output_dir, COOCCURRENCE_INDPTR_FILE), cooccurrence.indptr)
+    np.save(os.path.join(output_dir, COOCCURRENCE_INDICES_FILE), cooccurrence.indices)
+    np.save(os.path.join(output_dir, COOCCURRENCE_SCORES_FILE), scores)
+
+
+def has_fallback(artifact_dir):
+    return all(os.path.exists(os.path.join(artifact_dir, name)) for name in (
+        POPULAR_SONGS_FILE, COOCCURRENCE_INDPTR_FILE, COOCCURRENCE_INDICES_FILE, COOCCURRENCE_SCORES_FILE
+    ))
+
+
+class FallbackRecommender:
+    """Model-free recommendations from the precomputed popularity and co-occurrence tables.
+
+    A playlist's songs vote for their co-occurring songs (weighted by
+    co-occurrence count); the top-voted unseen songs come first and the most
+    popular unseen songs fill the rest. Unknown playlists get the popularity
+    ranking. Everything is memory-mapped and loads independently of the GNN
+    artifacts, so it can answer when the model can't.
+    """
+    def __init__(self, artifact_dir='artifacts'):
+        if not has_fallback(artifact_dir):
+            raise FileNotFoundError(
+                f"Fallback tables not found in {artifact_dir}. Re-run `python main.py --stage process`."
+            )
+        self.artifact_dir = artifact_dir
+        self.popular_songs = np.load(os.path.join(artifact_dir, POPULAR_SONGS_FILE), mmap_mode='r')
+        self.cooccurrence = PlaylistIndex(
+            np.load(os.path.join(artifact_dir, COOCCURRENCE_INDPTR_FILE), mmap_mode='r'),
+            np.load(os.path.join(artifact_dir, COOCCURRENCE_INDICES_FILE), mmap_mode='r')
+        )
+        self.cooccurrence_scores = np.load(os.path.join(artifact_dir, COOCCURRENCE_SCORES_FILE), mmap_mode='r')
+        self.song_mapping, self.playlist_mapping = load_mappings(artifact_dir)
+        self.playlist_index = load_playlist_index(artifact_dir)
+        self.song_metadata = load_song_metadata(artifact_dir)
+
+    def rank_songs(self, playlist_id, num_recommendations=10):
+        """Returns ranked song indices for a playlist ID; unknown playlists get the most popular songs."""
+        playlist_idx = self.playlist_mapping.get(playlist_id)
+        seen = self.playlist_index.songs(playlist_idx) if playlist_idx is not None else np.empty(0, dtype=np.int64)
+        return self.rank_from_songs(seen, num_recommendations)
+
+    def rank_for_tracks(self, track_uris, num_recommendations=10):
+        seeds = self.song_mapping.lookup([uri.split(':')[-1] for uri in track_uris])
+        return self.rank_from_songs(seeds[seeds >= 0], num_recommendations)
+
+    def rank_from_songs(self, seed_indices, num_recommendations=10):
+        """Ranks unseen songs by summed co-occurrence with ``seed_indices``, then by popularity."""
+        seed_indices = np.unique(seed_indices)
+        _, positions = self.cooccurrence.pair_positions(seed_indices)
+        ranked = np.empty(0, dtype=np.int64)
+        if len(positions):
+            neighbours = np.asarray(self.cooccurrence.indices[positions])
+            candidates, inverse = np.unique(neighbours, return_inverse=True)
+            votes = np.bincount(inverse, weights=np.asarray(self.cooccurrence_scores[positions]))
+            unseen = ~np.isin(candidates, seed_indices)
+            candidates, votes = candidates[unseen], votes[unseen]
+            ranked = candidates[np.argsort(-votes, kind='stable')][:num_recommendations]
+
+        if len(ranked) < num_recommendations:
+            # Top up with popular songs; over-fetch so excluded songs don't leave gaps
+            needed = num_recommendations - len(ranked)
+            popular = np.asarray(self.popular_songs[:needed + len(seed_indices) + len(ranked)])
+            popular = popular[~np.isin(popular, seed_indices) & ~np.isin(popular, ranked)]
+            ranked = np.concatenate([ranked, popular[:needed]])
+        return ranked
+
+    def get_song_metadata(self, song_indices):
+        """Returns a DataFrame of metadata for the given song indices, in order."""
+        return pd.DataFrame({
+            col: self.song_metadata[col].take(song_indices) for col in SONG_METADATA_COLUMNS
+        })
@@ -1,92 +1,357 @@
 import torch
-import json
 import pandas as pd
 import os
-from .model import Model # Use relative import within a package
+from .artifacts import (
+    PLAYLIST_EMBEDDINGS_FILE, SONG_EMBEDDINGS_FILE, SONG_FEATURES_FILE, SONG_HIDDEN_FILE, SONG_METADATA_COLUMNS,
+    build_playlist_index, build_song_metadata_pools, exported_embeddings_mismatch, file_sha256,
+    has_exported_embeddings, load_embedding_matrix, load_graph_id, load_mappings, load_playlist_index,
+    load_song_metadata
+)
+from .retrieval import IVF_INDEX_FILE, QUANTIZED_EMBEDDING_FILES, ExactIndex, IVFIndex, QuantizedIndex
+from .metrics import STAGE_SECONDS, STARTUP_SECONDS
+
+MODEL_WEIGHTS_FILE = 'trained_model_weights_gpu.pt'
+
+def _sage_params(state_dict, layer):
+    """Returns (lin_l.weight, lin_l.bias, lin_r.weight) of a layer's song->playlist SAGEConv.
+
+    Matched by substring because HeteroConv's internal key format for edge types
+    differs between torch_geometric versions.
+    """
+    prefix = [key for key in state_dict
+              if key.startswith(f'{layer}.convs.') and 'belongs_to' in key and key.endswith('lin_l.weight')]
+    if len(prefix) != 1:
+        raise KeyError(f"Could not find the song->playlist SAGEConv of {layer} in the model weights.")
+    prefix = prefix[0][:-len('lin_l.weight')]
+    return state_dict[prefix + 'lin_l.weight'], state_dict[prefix + 'lin_l.bias'], state_dict[prefix + 'lin_r.weight']
+
+class SeedPlaylistEncoder:
+    """Embeds a playlist that wasn't in the training graph from a list of seed songs.
+
+    Replays the model's two song->playlist SAGEConv (mean aggregation) layers for
+    a single new playlist node whose only neighbours are the seeds. It has no
+    learned input embedding, so its first-layer root term is zero:
+
+        h1 = relu(W1_l @ mean(x[seeds]) + b1_l)
+        h2 = W2_l @ mean(h1_song[seeds]) + b2_l + W2_r @ h1
+
+    Only the seed rows of the song features and first-layer song outputs are
+    read, so the cost is proportional to the number of seeds.
+    """
+    def __init__(self, state_dict, song_features, song_hidden):
+        self.song_features = song_features
+        self.song_hidden = song_hidden
+        self.w1_l, self.b1_l, _ = _sage_params(state_dict, 'conv1')
+        self.w2_l, self.b2_l, self.w2_r = _sage_params(state_dict, 'conv2')
+
+    @torch.no_grad()
+    def encode(self, seed_indices):
+        """Returns the [hidden_channels] embedding of a playlist made of ``seed_indices``."""
+        h1 = (self.song_features[seed_indices].mean(dim=0) @ self.w1_l.T + self.b1_l).relu()
+        return self.song_hidden[seed_indices].mean(dim=0) @ self.w2_l.T + self.b2_l + h1 @ self.w2_r.T
+
+    @torch.no_grad()
+    def encode_many(self, seed_indices, seed_rows, num_playlists):
+        """Batched encode: returns [num_playlists, hidden_channels] embeddings, where
+        ``seed_rows[i]`` is the playlist (row) that ``seed_indices[i]`` belongs to."""
+        counts = torch.bincount(seed_rows, minlength=num_playlists).clamp(min=1).unsqueeze(1)
+
+        def segment_mean(values):
+            sums = torch.zeros(num_playlists, values.shape[1], dtype=values.dtype, device=values.device)
+            return sums.index_add_(0, seed_rows, values) / counts
+
+        h1 = (segment_mean(self.song_features[seed_indices]) @ self.w1_l.T + self.b1_l).relu()
+        return segment_mean(self.song_hidden[seed_indices]) @ self.w2_l.T + self.b2_l + h1 @ self.w2_r.T
 
 class Recommender:
-    """Handles loading artifacts and generating song recommendations."""
-    def __init__(self, artifact_dir='artifacts'):
+    """Handles loading artifacts and generating song recommendations.
+
+    ``mode`` selects where the embeddings come from: 'embeddings' memory-maps the
+    files written by ``main.py --stage export`` (no graph, no torch_geometric),
+    'graph' rebuilds them with a full forward pass, and 'auto' prefers the
+    exported files when present. Exported files that don't match the current
+    mappings, graph build or weights (the export wasn't re-run after
+    processing or training) are rejected: 'embeddings' raises and 'auto'
+    falls back to 'graph'.
+
+    ``version`` identifies the loaded embeddings, so callers can key caches on
+    it, and ``embedding_stamp`` the export, graph build and weights they come
+    from, so indexes built from other embeddings are rejected.
+
+    ``retrieval`` selects the top-k backend: 'exact' scores every song, 'ivf' uses
+    the approximate index written by ``main.py --stage index`` and probes
+    ``nprobe`` of its lists per query, and 'int8'/'float16' scan the quantized
+    embeddings written by ``main.py --stage quantize`` and re-rank the best
+    ``rerank_factor * k`` songs exactly; they need embeddings mode.
+
+    ``drop_edges`` (offline evaluation only) is a (2, n) array of (song, playlist)
+    pairs removed from the graph before the forward pass and from the playlist
+    index; it needs ``mode='graph'`` and exact retrieval, since the exported and
+    quantized embeddings were computed with those pairs.
+    """
+    def __init__(self, artifact_dir='artifacts', retrieval='exact', nprobe=8, mode='auto', rerank_factor=4,
+                 drop_edges=None):
+        if drop_edges is not None and (mode != 'graph' or retrieval != 'exact'):
+            raise ValueError("drop_edges needs mode='graph' and retrieval='exact'.")
+        # --- Load all necessary artifacts ---
+        print("Loading artifacts...")
+        # Sorted, memory-mapped ID -> index arrays (older artifacts fall back to the JSON files)
+        with STARTUP_SECONDS.time(phase='mappings_load'):
+            self.song_mapping, self.playlist_mapping = load_mappings(artifact_dir)
+
+        if mode in ('auto', 'embeddings'):
+            exported, mismatch = has_exported_embeddings(artifact_dir), None
+            if exported:
+                mismatch = exported_embeddings_mismatch(
+                    artifact_dir, len(self.song_mapping), len(self.playlist_mapping),
+                    os.path.join(artifact_dir, MODEL_WEIGHTS_FILE)
+                )
+            if mode == 'embeddings' and mismatch is not None:
+                raise ValueError(f"{mismatch} Re-run `python main.py --stage export`.")
+            if mode == 'auto':
+                if mismatch is not None:
+                    print(f"WARNING: {mismatch} Computing embeddings from the graph instead; "
+                          f"re-run `python main.py --stage export` to restore fast startup.")
+                mode = 'embeddings' if exported and mismatch is None else 'graph'
+        self.mode = mode
+        if retrieval in QUANTIZED_EMBEDDING_FILES and mode != 'embeddings':
+            # The codes are quantized from the export, and only a memory-mapped export saves memory
+            raise ValueError(f"{retrieval} retrieval needs current exported embeddings (embeddings mode). "
+                             f"Re-run `python main.py --stage export` and `--stage quantize`.")
+
+        # --- Load the song metadata, indexed by song index ---
+        with STARTUP_SECONDS.time(phase='metadata_load'):
+            self.song_metadata = load_song_metadata(artifact_dir)
+        if self.song_metadata is None:
+            print("Song metadata not found in artifacts, building it from the cleaned CSV (re-run --stage process to avoid this)...")
+            with STARTUP_SECONDS.time(phase='csv_load'):
+                songs_df = pd.read_csv(
+                    os.path.join(artifact_dir, 'cleaned_playlists_and_tracks.csv'),
+                    usecols=['track_uri'] + SONG_METADATA_COLUMNS
+                ).drop_duplicates(subset='track_uri').set_index('track_uri')
+                ordered_uris = self.song_mapping.ordered_keys()
+                self.song_metadata = build_song_metadata_pools(songs_df.loc[ordered_uris])
+
+        with STARTUP_SECONDS.time(phase='playlist_index_load'):
+            self.playlist_index = load_playlist_index(artifact_dir)
+
+        # --- Get the final embeddings ---
+        if mode == 'embeddings':
+            self._load_exported_embeddings(artifact_dir)
+        elif mode == 'graph':
+            self._compute_graph_embeddings(artifact_dir, drop_edges)
+        else:
+            raise ValueError(f"Unknown mode '{mode}'. Choose 'auto', 'embeddings' or 'graph'.")
+
+        if self.playlist_index is None:
+            raise FileNotFoundError(
+                f"Playlist index not found in {artifact_dir}. Re-run `python main.py --stage process`."
+            )
+
+        # --- Set up the retrieval backend ---
+        if retrieval == 'exact':
+            self.retriever = ExactIndex(self.final_embeddings['song'])
+        elif retrieval == 'ivf':
+            with STARTUP_SECONDS.time(phase='ann_index_load'):
+                self.retriever = IVFIndex.load(
+                    os.path.join(artifact_dir, IVF_INDEX_FILE), self.final_embeddings['song'], nprobe=nprobe,
+                    embedding_stamp=self.embedding_stamp
+                )
+        elif retrieval in QUANTIZED_EMBEDDING_FILES:
+            with STARTUP_SECONDS.time(phase='quantized_index_load'):
+                self.retriever = QuantizedIndex.load(
+                    artifact_dir, self.final_embeddings['song'], retrieval, rerank_factor=rerank_factor,
+                    embedding_stamp=self.embedding_stamp
+                )
+        else:
+            raise ValueError(f"Unknown retrieval backend '{retrieval}'. Choose 'exact', 'ivf', 'int8' or 'float16'.")
+        print(f"Recommender ready ({mode} mode, {retrieval} retrieval).")
+
+    def _load_exported_embeddings(self, artifact_dir):
+        """Memory-maps the exported embedding files; pages are shared across worker processes."""
+        self.device = torch.device('cpu')
+        print("Memory-mapping exported embeddings...")
+        with STARTUP_SECONDS.time(phase='embeddings_load'):
+            song_embeddings, song_header = load_embedding_matrix(os.path.join(artifact_dir, SONG_EMBEDDINGS_FILE))
+            playlist_embeddings, _ = load_embedding_matrix(os.path.join(artifact_dir, PLAYLIST_EMBEDDINGS_FILE))
+        self.final_embeddings = {
+            'song': torch.from_numpy(song_embeddings),
+            'playlist': torch.from_numpy(playlist_embeddings),
+        }
+        self.version = song_header['checksum'][:12]
+        # The export was checked against the graph build and weights, so its header identifies them
+        self.embedding_stamp = {
+            'embeddings_checksum': song_header['checksum'],
+            'graph_id': song_header['graph_id'],
+            'weights_sha256': song_header['weights_sha256'],
+        }
+        print(f"Loaded embeddings with checksum {self.version}.")
+
+        # --- Seed-track encoder inputs (optional; written by newer exports) ---
+        self.seed_encoder = None
+        features_path = os.path.join(artifact_dir, SONG_FEATURES_FILE)
+        hidden_path = os.path.join(artifact_dir, SONG_HIDDEN_FILE)
+        if os.path.exists(features_path) and os.path.exists(hidden_path):
+            state_dict = torch.load(os.path.join(artifact_dir, MODEL_WEIGHTS_FILE), map_location=self.device)
+            self.seed_encoder = SeedPlaylistEncoder(
+                state_dict,
+                torch.from_numpy(load_embedding_matrix(features_path)[0]),
+                torch.from_numpy(load_embedding_matrix(hidden_path)[0])
+            )
+
+    def _compute_graph_embeddings(self, artifact_dir, drop_edges=None):
+        """Loads the graph and trained weights and runs a full forward pass."""
+        from .model import Model  # Imported here so embeddings mode never loads torch_geometric
+
         # --- THIS IS THE FIX (Part 1) ---
         # Define the map location based on where the code is running
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print(f"Using device: {self.device}")
 
-        # --- Load all necessary artifacts ---
-        print("Loading artifacts...")
+        weights_path = os.path.join(artifact_dir, MODEL_WEIGHTS_FILE)
+        weights_stat = os.stat(weights_path)
+        self.version = f"graph-{int(weights_stat.st_mtime)}-{weights_stat.st_size}"
+        self.embedding_stamp = None if drop_edges is not None else {
+            'embeddings_checksum': None,
+            'graph_id': load_graph_id(artifact_dir),
+            'weights_sha256': file_sha256(weights_path),
+        }
+
         # Apply the map_location to the torch.load calls
-        self.data = torch.load(
-            os.path.join(artifact_dir, 'graph_data.pt'), 
-            weights_only=False
-        ).to(self.device)
-        self.data['playlist'].node_id = torch.arange(self.data['playlist'].num_nodes).to(self.device)
+        with STARTUP_SECONDS.time(phase='graph_load'):
+            self.data = torch.load(
+                os.path.join(artifact_dir, 'graph_data.pt'), 
+                weights_only=False
+            ).to(self.device)
+            self.data['playlist'].node_id = torch.arange(self.data['playlist'].num_nodes).to(self.device)
 
-        # (JSON loading remains the same)
-        with open(os.path.join(artifact_dir, 'song_mapping.json'), 'r') as f:
-            self.song_mapping = json.load(f)
-        with open(os.path.join(artifact_dir, 'playlist_mapping.json'), 'r') as f:
-            self.playlist_mapping = json.load(f)
+        if drop_edges is not None:
+            edge_index = self.data['song', 'belongs_to', 'playlist'].edge_index
+            num_songs = self.data['song'].num_nodes
+            drop_keys = torch.as_tensor(drop_edges[1] * num_songs + drop_edges[0], device=self.device)
+            edge_index = edge_index[:, ~torch.isin(edge_index[1] * num_songs + edge_index[0], drop_keys)]
+            print(f"Removed {self.data['song', 'belongs_to', 'playlist'].num_edges - edge_index.shape[1]} "
+                  f"held-out edges from the graph.")
+            self.data['song', 'belongs_to', 'playlist'].edge_index = edge_index
+            self.data['playlist', 'contains', 'song'].edge_index = edge_index.flip(0)
+            edge_index = edge_index.cpu().numpy()
+            self.playlist_index = build_playlist_index(edge_index[0], edge_index[1], self.data['playlist'].num_nodes)
 
-        self.inv_song_mapping = {v: k for k, v in self.song_mapping.items()}
-        self.enriched_df = pd.read_csv(os.path.join(artifact_dir, 'cleaned_playlists_and_tracks.csv'))
+        # --- Build the playlist -> songs index used for masking if it wasn't saved ---
+        if self.playlist_index is None:
+            print("Playlist index not found in artifacts, building it from the graph...")
+            edge_index = self.data['song', 'belongs_to', 'playlist'].edge_index.cpu().numpy()
+            self.playlist_index = build_playlist_index(
+                edge_index[0], edge_index[1], self.data['playlist'].num_nodes
+            )
 
         # --- Load the trained model ---
-        self.model = Model(
-            hidden_channels=64,
-            num_playlists=self.data['playlist'].num_nodes,
-            num_song_features=self.data['song'].x.shape[1]
-        ).to(self.device)
-        
-        # --- THIS IS THE FIX (Part 2) ---
-        # Apply the map_location here as well
-        self.model.load_state_dict(
-            torch.load(
-                os.path.join(artifact_dir, 'trained_model_weights_gpu.pt'), 
-                map_location=self.device
+        with STARTUP_SECONDS.time(phase='model_load'):
+            self.model = Model(
+                hidden_channels=64,
+                num_playlists=self.data['playlist'].num_nodes,
+                num_song_features=self.data['song'].x.shape[1]
+            ).to(self.device)
+            
+            # --- THIS IS THE FIX (Part 2) ---
+            # Apply the map_location here as well
+            self.model.load_state_dict(
+                torch.load(
+                    weights_path, 
+                    map_location=self.device
+                )
             )
-        )
-        self.model.eval()
+            self.model.eval()
 
         # --- Generate final embeddings ---
         print("Generating final embeddings for all nodes...")
-        with torch.no_grad():
-            self.final_embeddings = self.model(self.data)
-        print("Recommender ready.")
+        with STARTUP_SECONDS.time(phase='forward_pass'), torch.no_grad():
+            self.final_embeddings, hidden = self.model(self.data, return_hidden=True)
+        self.seed_encoder = SeedPlaylistEncoder(self.model.state_dict(), self.data['song'].x, hidden['song'])
 
     def get_recommendations(self, playlist_id, num_recommendations=10):
         """Generates song recommendations for a given playlist ID."""
-        if str(playlist_id) not in self.playlist_mapping:
+        ranked = self.rank_songs(playlist_id, num_recommendations)
+        if ranked is None:
             return {"error": f"Playlist ID {playlist_id} not found in the dataset."}
+        
+        return self.get_song_metadata(ranked)
+
+    def rank_songs(self, playlist_id, num_recommendations=10):
+        """Returns the ranked song indices recommended for a playlist ID, or None if it is unknown."""
+        playlist_idx = self.playlist_mapping.get(playlist_id)
+        if playlist_idx is None:
+            return None
+
+        top_k_indices = self.top_k_songs([playlist_idx], num_recommendations)[0].cpu().numpy()
+        return top_k_indices[top_k_indices >= 0]
+
+    def get_recommendations_batch(self, playlist_ids, num_recommendations=10, chunk_size=1024):
+        """Generates recommendations for many playlist IDs, returned in input order.
+
+        Unknown playlists get an error dict in their slot, like get_recommendations.
+        """
+        lookup = self.playlist_mapping.lookup(playlist_ids)
+        positions = (lookup >= 0).nonzero()[0]
+        results = [{"error": f"Playlist ID {pid} not found in the dataset."} for pid in playlist_ids]
+        if len(positions) == 0:
+            return results
 
-        # Get embeddings for all songs and the target playlist
-        song_embeddings = self.final_embeddings['song']
+        top_k_indices = self.top_k_songs(lookup[positions], num_recommendations, chunk_size=chunk_size).cpu().numpy()
+        for pos, song_indices in zip(positions, top_k_indices):
+            results[pos] = self.get_song_metadata(song_indices)
+        return results
+
+    def get_recommendations_for_tracks(self, track_uris, num_recommendations=10):
+        """Generates recommendations for a playlist that isn't in the dataset, from its track URIs.
+
+        Accepts bare track IDs or full ``spotify:track:`` URIs; unknown tracks are ignored.
+        """
+        if self.seed_encoder is None:
+            return {"error": "Seed-track recommendations need song_features.emb/song_hidden.emb; re-run --stage export."}
+
+        seed_indices = self.song_mapping.lookup([uri.split(':')[-1] for uri in track_uris])
+        seed_indices = seed_indices[seed_indices >= 0]
+        if len(seed_indices) == 0:
+            return {"error": "None of the given tracks are in the dataset."}
+
+        seeds = torch.as_tensor(seed_indices, device=self.device)
+        query = self.seed_encoder.encode(seeds).unsqueeze(0)
+        _, top_k_indices = self.retriever.search(query, num_recommendations, torch.zeros_like(seeds), seeds)
+        return self.get_song_metadata(top_k_indices[0].cpu().numpy())
+
+    def top_k_songs(self, playlist_indices, k, chunk_size=1024):
+        """Returns a [len(playlist_indices), k] tensor of the best unseen song indices per playlist.
+
+        Playlists are scored ``chunk_size`` at a time through the retrieval backend.
+        Approximate backends may pad a row with -1 when they find fewer than k songs.
+        """
         playlist_embeddings = self.final_embeddings['playlist']
-        
-        playlist_idx = self.playlist_mapping[str(playlist_id)]
-        playlist_emb = playlist_embeddings[playlist_idx]
 
-        # Calculate similarity scores
-        scores = song_embeddings @ playlist_emb
+        results = []
+        for chunk_start in range(0, len(playlist_indices), chunk_size):
+            chunk = playlist_indices[chunk_start:chunk_start + chunk_size]
+            with STAGE_SECONDS.time(stage='embedding_lookup'):
+                queries = playlist_embeddings[torch.as_tensor(chunk, device=self.device)]
 
-        # Filter out songs already in the playlist
-        songs_in_playlist = set(self.enriched_df[self.enriched_df['pid'] == playlist_id]['track_uri'].unique())
-        mask = torch.ones(len(self.song_mapping), dtype=torch.bool, device=self.device)
-        
-        for uri in songs_in_playlist:
-            if uri in self.song_mapping:
-                song_idx = self.song_mapping[uri]
-                mask[song_idx] = False
-        
-        scores[~mask] = -torch.inf
+            # Songs already in each playlist, as (row, song_index) pairs
+            with STAGE_SECONDS.time(stage='seen_lookup'):
+                seen_rows, seen_cols = self.playlist_index.seen_pairs(chunk)
+                seen_rows = torch.from_numpy(seen_rows).to(self.device)
+                seen_cols = torch.from_numpy(seen_cols).to(self.device)
 
-        # Get top-N recommendations
-        _, top_k_indices = torch.topk(scores, k=num_recommendations)
-        
-        recommended_uris = [self.inv_song_mapping[idx.item()] for idx in top_k_indices]
-        
-        recs_df = self.enriched_df[self.enriched_df['track_uri'].isin(recommended_uris)][['track_name_x', 'artists']].drop_duplicates()
-        
-        return recs_df
+            _, top_k_indices = self.retriever.search(queries, k, seen_rows, seen_cols)
+            results.append(top_k_indices)
+        return torch.cat(results)
+
+    def get_song_metadata(self, song_indices):
+        """Returns a DataFrame of song metadata for the given song indices, in the same order.
+        Padding indices (-1) are skipped."""
+        song_indices = song_indices[song_indices >= 0]
+        with STAGE_SECONDS.time(stage='metadata_join'):
+            return pd.DataFrame({
+                col: self.song_metadata[col].take(song_indices) for col in SONG_METADATA_COLUMNS
+            })
 
 if __name__ == '__main__':
     # This block allows you to test the script directly
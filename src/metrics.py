@@ -0,0 +1,204 @@
+# src/metrics.py
+import cProfile
+import contextvars
+import io
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from 100us to 30s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    """Monotonic counter, rendered in the Prometheus text format."""
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram, rendered in the Prometheus text format."""
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the wall-clock duration of the ``with`` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", bound)])} {count}')
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, [("le", "+Inf")])} {series[-1]}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}')
+        return lines
+
+class MetricsRegistry:
+    """Collects metrics and renders them for a /metrics endpoint.
+
+    ``collectors`` are callables returning extra, already-formatted lines; they
+    export values that live elsewhere (e.g. cache counters) at scrape time.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = MetricsRegistry()
+
+STARTUP_SECONDS = REGISTRY.histogram(
+    'recommender_startup_phase_seconds', 'Time spent in each phase of Recommender startup.',
+    labelnames=('phase',), buckets=(0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    'recommendation_stage_seconds', 'Time spent in each stage of producing recommendations.',
+    labelnames=('stage',)
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'HTTP request latency.', labelnames=('method', 'path')
+)
+HTTP_REQUESTS = REGISTRY.counter(
+    'http_requests_total', 'HTTP requests by response status.', labelnames=('method', 'path', 'status')
+)
+FALLBACK_RESPONSES = REGISTRY.counter(
+    'recommendation_fallbacks_total', 'Rankings served by the fallback recommender, by reason.', labelnames=('reason',)
+)
+
+class RequestProfiler:
+    """Opt-in cProfile sampling of the model work done for individual requests.
+
+    ``sample_request`` marks a ``sample_rate`` fraction (0 disables; changeable
+    at runtime) of requests as sampled. The mark follows the request's context
+    into threadpool endpoints and is carried into the inference scheduler with
+    each job (``current_request``); ``profile`` then runs cProfile around the
+    synchronous section that does the work, in the thread that runs it, and
+    tags the report with the sampled requests it served. Profiling the event
+    loop instead would only show asyncio's own frames and other requests'
+    work. Only one section is profiled at a time, since the interpreter allows
+    a single active profiler; the ``max_profiles`` most recent reports are kept.
+    """
+    def __init__(self, sample_rate=0.0, max_profiles=20, top_n=30):
+        self.sample_rate = sample_rate
+        self.top_n = top_n
+        self.profiles = deque(maxlen=max_profiles)
+        self._busy = threading.Lock()
+        self._current = contextvars.ContextVar('profiled_request', default=None)
+
+    @contextmanager
+    def sample_request(self, label):
+        """Decides whether the enclosed request is profiled; yields its request id
+        (also part of the profile tags) if so, else None."""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            yield None
+            return
+        request_id = uuid.uuid4().hex[:12]
+        token = self._current.set(f"{label} {request_id}")
+        try:
+            yield request_id
+        finally:
+            self._current.reset(token)
+
+    def current_request(self):
+        """The tag of the sampled request being handled in this context, or None."""
+        return self._current.get()
+
+    @contextmanager
+    def profile(self, requests=None, **details):
+        """Profiles the enclosed section if any of ``requests`` (tags; the current
+        request by default) is sampled. ``details`` are stored with the report."""
+        requests = [self.current_request()] if requests is None else requests
+        requests = [request for request in requests if request is not None]
+        if not requests or not self._busy.acquire(blocking=False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+            yield
+        finally:
+            profiler.disable()
+            self._busy.release()
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(self.top_n)
+            self.profiles.append({
+                'requests': requests,
+                'thread': threading.current_thread().name,
+                'timestamp': time.time(),
+                'duration_seconds': time.perf_counter() - start,
+                **details,
+                'report': report.getvalue(),
+            })
+
+PROFILER = RequestProfiler()
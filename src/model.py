@@ -19,14 +19,17 @@ class Model(torch.nn.Module):
             ('playlist', 'contains', 'song'): SAGEConv(hidden_channels, hidden_channels),
         }, aggr='sum')
 
-    def forward(self, data):
+    def forward(self, data, return_hidden=False):
         x_dict = {
           "song": data["song"].x,
           "playlist": self.playlist_embed(data["playlist"].node_id),
         }
         x_dict = self.conv1(x_dict, data.edge_index_dict)
-        x_dict = {key: x.relu() for key, x in x_dict.items()}
-        x_dict = self.conv2(x_dict, data.edge_index_dict)
+        hidden_dict = {key: x.relu() for key, x in x_dict.items()}
+        x_dict = self.conv2(hidden_dict, data.edge_index_dict)
+        if return_hidden:
+            # The first-layer outputs let new playlists be embedded from their songs alone
+            return x_dict, hidden_dict
         return x_dict
 
     def decode(self, song_embedding, playlist_embedding):
@@ -0,0 +1,162 @@
+# src/registry.py
+import gc
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+import torch
+
+# Version directories use the timestamp layout of scripts/sync_s3.py
+VERSION_DIR_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$')
+
+def list_versions(root_dir):
+    """Returns the complete version directories under ``root_dir``, oldest first."""
+    if not os.path.isdir(root_dir):
+        return []
+    return sorted(name for name in os.listdir(root_dir)
+                  if VERSION_DIR_PATTERN.match(name) and os.path.isdir(os.path.join(root_dir, name)))
+
+def resolve_artifact_dir(root_dir, version=None):
+    """Returns the artifact directory to load: the given version, the latest version,
+    or ``root_dir`` itself when it holds a flat (unversioned) set of artifacts."""
+    if version is not None:
+        path = os.path.join(root_dir, version)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Artifact version '{version}' not found in {root_dir}.")
+        return path
+    versions = list_versions(root_dir)
+    return os.path.join(root_dir, versions[-1]) if versions else root_dir
+
+class ModelHandle:
+    """One loaded model version plus the count of requests currently using it."""
+    def __init__(self, artifact_dir, recommender, scheduler=None):
+        self.artifact_dir = artifact_dir
+        self.recommender = recommender
+        self.scheduler = scheduler
+        self.loaded_at = time.time()
+        self._refs = 0
+        self._retired = False
+
+class ModelRegistry:
+    """Holds the live model and swaps in new artifact versions without a restart.
+
+    ``factory(artifact_dir)`` returns the (recommender, scheduler) pair for one
+    version and ``on_swap(handle)`` runs after each swap. A new version is built
+    off to the side and swapped in atomically; requests that acquired the old
+    version finish on it, and it is closed and released once the last of them
+    is done. The release (joining the scheduler's workers, garbage collection)
+    runs in a background thread, so the request that drains a version never
+    blocks the event loop on it.
+    """
+    def __init__(self, root_dir, factory, on_swap=None):
+        self.root_dir = root_dir
+        self.factory = factory
+        self.on_swap = on_swap
+        self.current = None
+        self.loading = False
+        self.last_error = None
+        self._failed_dir = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._watcher = None
+        self._stop_watching = threading.Event()
+
+    @contextmanager
+    def acquire(self):
+        """Yields the current ModelHandle (or None) and keeps it alive until the block exits."""
+        with self._lock:
+            handle = self.current
+            if handle is not None:
+                handle._refs += 1
+        try:
+            yield handle
+        finally:
+            if handle is not None:
+                with self._lock:
+                    handle._refs -= 1
+                    drained = handle._retired and handle._refs == 0
+                if drained:
+                    self._release_in_background(handle)
+
+    def load(self, version=None):
+        """Builds the requested (default: latest) version and swaps it in. Blocks until done."""
+        with self._load_lock:
+            self.loading = True
+            artifact_dir = None
+            try:
+                artifact_dir = resolve_artifact_dir(self.root_dir, version)
+                print(f"Loading model artifacts from {artifact_dir}...")
+                new_handle = ModelHandle(artifact_dir, *self.factory(artifact_dir))
+            except Exception as e:
+                self.last_error = str(e)
+                self._failed_dir = artifact_dir
+                raise
+            finally:
+                self.loading = False
+
+            with self._lock:
+                old_handle, self.current = self.current, new_handle
+                self.last_error = None
+                drained = False
+                if old_handle is not None:
+                    old_handle._retired = True
+                    drained = old_handle._refs == 0
+            if self.on_swap is not None:
+                self.on_swap(new_handle)
+            if drained:
+                self._release(old_handle)
+            print(f"Now serving artifacts from {artifact_dir}.")
+            return new_handle
+
+    def reload_in_background(self, version=None):
+        """Starts load() in a background thread; returns False if a load is already running."""
+        # Checked and set together, so concurrent callers can't both start a load
+        with self._lock:
+            if self.loading:
+                return False
+            self.loading = True
+
+        def run():
+            try:
+                self.load(version)
+            except Exception as e:
+                print(f"ERROR: Reload failed, still serving the previous version. Error: {e}")
+
+        threading.Thread(target=run, name='model-reload', daemon=True).start()
+        return True
+
+    def start_watcher(self, interval_seconds):
+        """Polls ``root_dir`` and loads any newer version directory that appears."""
+        def watch():
+            while not self._stop_watching.wait(interval_seconds):
+                latest = resolve_artifact_dir(self.root_dir)
+                current = self.current
+                is_new = current is None or latest != current.artifact_dir
+                # Don't retry a directory that already failed to load until it changes
+                if is_new and latest != self._failed_dir and not self.loading:
+                    print(f"Watcher found new artifacts at {latest}.")
+                    self.reload_in_background()
+
+        self._watcher = threading.Thread(target=watch, name='artifact-watcher', daemon=True)
+        self._watcher.start()
+
+    def close(self):
+        """Stops the watcher and releases the current version."""
+        self._stop_watching.set()
+        with self._lock:
+            handle, self.current = self.current, None
+        if handle is not None:
+            self._release(handle)
+
+    def _release_in_background(self, handle):
+        threading.Thread(target=self._release, args=(handle,), name='model-release', daemon=True).start()
+
+    def _release(self, handle):
+        print(f"Releasing artifacts from {handle.artifact_dir}.")
+        if handle.scheduler is not None:
+            handle.scheduler.close()
+        handle.recommender = handle.scheduler = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -0,0 +1,420 @@
+# src/retrieval.py
+import math
+import os
+import time
+import json
+import numpy as np
+import torch
+
+from .artifacts import embedding_stamp_mismatch
+from .metrics import STAGE_SECONDS
+
+IVF_INDEX_FILE = 'ivf_index.pt'
+# Quantized copies of song_embeddings.emb, written by `main.py --stage quantize`
+QUANTIZED_EMBEDDING_FILES = {
+    'int8': 'song_embeddings_int8.npy',
+    'float16': 'song_embeddings_float16.npy',
+}
+INT8_SCALES_FILE = 'song_embeddings_int8_scales.npy'
+
+
+def _stamp_path(codes_path):
+    """The JSON file next to quantized codes recording the embeddings they were quantized from."""
+    return f'{os.path.splitext(codes_path)[0]}_stamp.json'
+
+
+def _mask_seen(scores, seen_rows, seen_cols, col_start, col_end):
+    """Sets scores of (row, song) pairs falling in [col_start, col_end) to -inf."""
+    if seen_rows is None:
+        return
+    in_range = (seen_cols >= col_start) & (seen_cols < col_end)
+    scores[seen_rows[in_range], seen_cols[in_range] - col_start] = -torch.inf
+
+
+class ExactIndex:
+    """Brute-force inner-product search over all song embeddings."""
+    def __init__(self, song_embeddings, block_size=262144):
+        self.song_embeddings = song_embeddings
+        self.block_size = block_size
+
+    @property
+    def num_songs(self):
+        return self.song_embeddings.shape[0]
+
+    def search(self, queries, k, seen_rows=None, seen_cols=None):
+        """Returns ([B, k] scores, [B, k] song indices) for a batch of query embeddings.
+
+        Songs are scored in blocks of ``block_size`` with a running top-k, so the
+        score matrix never exceeds B x block_size. (row, song) pairs given in
+        ``seen_rows``/``seen_cols`` are excluded.
+        """
+        k = min(k, self.num_songs)
+        best_scores, best_indices = None, None
+        # Stage times are summed over blocks and recorded once per search
+        scoring_seconds = masking_seconds = top_k_seconds = 0.0
+        for block_start in range(0, self.num_songs, self.block_size):
+            block_end = min(block_start + self.block_size, self.num_songs)
+            start = time.perf_counter()
+            scores = self._score_block(queries, block_start, block_end)
+            scoring_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            _mask_seen(scores, seen_rows, seen_cols, block_start, block_end)
+            masking_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            block_scores, block_indices = torch.topk(scores, k=min(k, block_end - block_start), dim=1)
+            block_indices += block_start
+            if best_scores is not None:
+                block_scores = torch.cat([best_scores, block_scores], dim=1)
+                block_indices = torch.cat([best_indices, block_indices], dim=1)
+                block_scores, order = torch.topk(block_scores, k=min(k, block_scores.shape[1]), dim=1)
+                block_indices = torch.gather(block_indices, 1, order)
+            best_scores, best_indices = block_scores, block_indices
+            top_k_seconds += time.perf_counter() - start
+
+        STAGE_SECONDS.observe(scoring_seconds, stage='scoring')
+        STAGE_SECONDS.observe(masking_seconds, stage='masking')
+        STAGE_SECONDS.observe(top_k_seconds, stage='top_k')
+        return best_scores, best_indices
+
+    def _score_block(self, queries, block_start, block_end):
+        return queries @ self.song_embeddings[block_start:block_end].T
+
+
+def quantize_embeddings(embeddings, dtype='int8', chunk_size=262144):
+    """Returns (codes, scales) for a float32 embedding matrix.
+
+    'int8' stores each row as round(row / scale) with scale = max|row| / 127, so
+    a score is ``(query @ codes.T) * scale``; 'float16' is a plain cast and has
+    no scales.
+    """
+    if dtype == 'float16':
+        return torch.cat([embeddings[i:i + chunk_size].half() for i in range(0, embeddings.shape[0], chunk_size)]), None
+    if dtype != 'int8':
+        raise ValueError(f"Unknown quantization dtype '{dtype}'. Choose 'int8' or 'float16'.")
+    codes, scales = [], []
+    for i in range(0, embeddings.shape[0], chunk_size):
+        chunk = embeddings[i:i + chunk_size].float()
+        chunk_scales = chunk.abs().amax(dim=1).clamp(min=1e-12) / 127
+        codes.append(torch.round(chunk / chunk_scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8))
+        scales.append(chunk_scales)
+    return torch.cat(codes), torch.cat(scales)
+
+
+class QuantizedIndex(ExactIndex):
+    """Exact search over int8 (per-row scaled) or float16 copies of the song
+    embeddings, followed by an exact float32 re-rank of the best
+    ``rerank_factor * k`` candidates.
+
+    The scan runs low-precision kernels. On CPU, int8 blocks are packed once
+    into dynamic quantized linear layers (fbgemm/oneDNN int8 GEMM, the
+    per-song scales as per-channel weight scales, queries quantized on the
+    fly), and float16 codes are converted to bfloat16 for a bf16 matmul. On
+    GPU both are scored with a float16 matmul. int8 is fastest for small
+    batches (single requests), bf16 for large ones, where writing the score
+    matrix dominates.
+
+    Meant for embeddings mode: the float32 matrix is then a memory-mapped
+    export that is only touched for the re-ranked rows.
+    """
+    def __init__(self, song_embeddings, codes, scales=None, rerank_factor=4, block_size=262144):
+        super().__init__(song_embeddings, block_size=block_size)
+        self.codes = codes
+        self.scales = scales
+        self.rerank_factor = rerank_factor
+        self._blocks = [self._prepare_block(block_start, min(block_start + block_size, self.num_songs))
+                        for block_start in range(0, self.num_songs, block_size)]
+
+    def _prepare_block(self, block_start, block_end):
+        codes = self.codes[block_start:block_end]
+        if codes.device.type != 'cpu':
+            return codes.half()
+        if self.scales is None:
+            return codes.to(torch.bfloat16)
+        # Per-channel qint8 weight: one output channel (and scale) per song; re-quantizing
+        # the dequantized codes with the same scales gives back the same codes
+        scales = self.scales[block_start:block_end]
+        weight = torch.quantize_per_channel(
+            codes.float() * scales.unsqueeze(1), scales.double(),
+            torch.zeros(block_end - block_start, dtype=torch.long), 0, torch.qint8
+        )
+        layer = torch.ao.nn.quantized.dynamic.Linear(codes.shape[1], block_end - block_start, dtype=torch.qint8)
+        layer.set_weight_bias(weight, None)
+        return layer
+
+    def _score_block(self, queries, block_start, block_end):
+        block = self._blocks[block_start // self.block_size]
+        if isinstance(block, torch.nn.Module):
+            return block(queries)
+        scores = queries.to(block.dtype) @ block.T
+        if self.scales is not None:
+            scores *= self.scales[block_start:block_end].to(block.dtype)
+        return scores
+
+    def search(self, queries, k, seen_rows=None, seen_cols=None):
+        k = min(k, self.num_songs)
+        approx_scores, candidates = super().search(queries, k * self.rerank_factor, seen_rows, seen_cols)
+        with STAGE_SECONDS.time(stage='rerank'):
+            exact_scores = torch.einsum('bd,bcd->bc', queries, self.song_embeddings[candidates])
+            # Seen songs keep their exclusion when fewer unseen candidates exist
+            exact_scores = exact_scores.masked_fill(approx_scores == -torch.inf, -torch.inf)
+            scores, order = torch.topk(exact_scores, k=k, dim=1)
+            return scores, torch.gather(candidates, 1, order)
+
+    def save(self, artifact_dir, dtype, embedding_stamp=None):
+        """Writes the codes (and scales) and ``embedding_stamp``, the Recommender's stamp
+        of the embeddings they were quantized from."""
+        codes_path = os.path.join(artifact_dir, QUANTIZED_EMBEDDING_FILES[dtype])
+        np.save(codes_path, self.codes.cpu().numpy())
+        if self.scales is not None:
+            np.save(os.path.join(artifact_dir, INT8_SCALES_FILE), self.scales.cpu().numpy())
+        with open(_stamp_path(codes_path), 'w') as f:
+            json.dump(embedding_stamp or {}, f, indent=2)
+
+    @classmethod
+    def load(cls, artifact_dir, song_embeddings, dtype, rerank_factor=4, embedding_stamp=None):
+        """Memory-maps the codes (and scales) written by ``main.py --stage quantize``.
+
+        Codes quantized from other embeddings than ``embedding_stamp`` describes
+        (e.g. the model was retrained and re-exported since) are rejected.
+        """
+        codes_path = os.path.join(artifact_dir, QUANTIZED_EMBEDDING_FILES[dtype])
+        if not os.path.exists(codes_path):
+            raise FileNotFoundError(f"{codes_path} not found. Run `python main.py --stage quantize` first.")
+        if embedding_stamp is not None:
+            if os.path.exists(_stamp_path(codes_path)):
+                with open(_stamp_path(codes_path), 'r') as f:
+                    mismatch = embedding_stamp_mismatch(json.load(f), embedding_stamp)
+                if mismatch is not None:
+                    raise ValueError(f"{codes_path} {mismatch}. Re-run `python main.py --stage quantize`.")
+            else:
+                print(f"WARNING: {codes_path} has no stamp and can't be checked against the embeddings; "
+                      f"re-run `python main.py --stage quantize`.")
+        # Copy-on-write maps, since torch.from_numpy doesn't accept read-only arrays
+        codes = torch.from_numpy(np.load(codes_path, mmap_mode='c'))
+        if codes.shape != song_embeddings.shape:
+            raise ValueError(f"{codes_path} has shape {tuple(codes.shape)} but the embeddings have "
+                             f"{tuple(song_embeddings.shape)}. Re-run `python main.py --stage quantize`.")
+        scales = None
+        if dtype == 'int8':
+            scales = torch.from_numpy(np.load(os.path.join(artifact_dir, INT8_SCALES_FILE), mmap_mode='c'))
+        device = song_embeddings.device
+        return cls(song_embeddings, codes.to(device),
+                   scales.to(device) if scales is not None else None, rerank_factor=rerank_factor)
+
+
+class IVFIndex:
+    """Inverted-file ANN index: songs are bucketed by k-means centroid and a query
+    only scores the songs in its ``nprobe`` best-matching buckets.
+
+    Raising ``nprobe`` trades speed for recall; use ``evaluate_recall`` to pick it.
+    """
+    def __init__(self, song_embeddings, centroids, list_offsets, list_ids, nprobe=8):
+        self.song_embeddings = song_embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    @property
+    def num_songs(self):
+        return self.song_embeddings.shape[0]
+
+    @property
+    def num_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, song_embeddings, num_lists=None, num_iters=20, max_train_points=262144,
+              nprobe=8, chunk_size=65536, seed=0):
+        """Clusters the song embeddings with k-means and buckets every song by nearest centroid."""
+        num_songs = song_embeddings.shape[0]
+        if num_lists is None:
+            num_lists = max(1, int(4 * math.sqrt(num_songs)))
+        num_lists = min(num_lists, num_songs)
+        generator = torch.Generator().manual_seed(seed)
+
+        # --- Train centroids on a sample of the songs ---
+        sample = torch.randperm(num_songs, generator=generator)[:max_train_points].to(song_embeddings.device)
+        train_points = song_embeddings[sample]
+        centroids = train_points[torch.randperm(train_points.shape[0], generator=generator)[:num_lists].to(song_embeddings.device)].clone()
+        for _ in range(num_iters):
+            assignments = cls._assign(train_points, centroids, chunk_size)
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, train_points)
+            counts = torch.bincount(assignments, minlength=num_lists).unsqueeze(1)
+            # Empty clusters keep their previous centroid
+            centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+
+        # --- Bucket every song ---
+        assignments = cls._assign(song_embeddings, centroids, chunk_size)
+        list_ids = torch.argsort(assignments, stable=True)
+        list_offsets = torch.zeros(num_lists + 1, dtype=torch.long, device=song_embeddings.device)
+        list_offsets[1:] = torch.cumsum(torch.bincount(assignments, minlength=num_lists), dim=0)
+        return cls(song_embeddings, centroids, list_offsets, list_ids, nprobe=nprobe)
+
+    @staticmethod
+    def _assign(points, centroids, chunk_size):
+        """Returns the index of the nearest (L2) centroid for each point, computed in chunks."""
+        centroid_norms = (centroids * centroids).sum(dim=1)
+        assignments = []
+        for start in range(0, points.shape[0], chunk_size):
+            chunk = points[start:start + chunk_size]
+            distances = centroid_norms.unsqueeze(0) - 2 * chunk @ centroids.T
+            assignments.append(distances.argmin(dim=1))
+        return torch.cat(assignments)
+
+    def save(self, path, embedding_stamp=None):
+        """Writes the index with ``embedding_stamp``, the Recommender's stamp of the
+        embeddings it was built from."""
+        torch.save({
+            'centroids': self.centroids.cpu(),
+            'list_offsets': self.list_offsets.cpu(),
+            'list_ids': self.list_ids.cpu(),
+            'num_songs': self.num_songs,
+            'embedding_stamp': embedding_stamp,
+        }, path)
+
+    @classmethod
+    def load(cls, path, song_embeddings, nprobe=8, embedding_stamp=None):
+        """Loads an index written by ``save``, rejecting one built from other
+        embeddings than ``embedding_stamp`` describes."""
+        state = torch.load(path, map_location=song_embeddings.device)
+        if state['num_songs'] != song_embeddings.shape[0]:
+            raise ValueError(
+                f"IVF index was built for {state['num_songs']} songs but the embeddings have "
+                f"{song_embeddings.shape[0]}. Rebuild it with `python main.py --stage index`."
+            )
+        if embedding_stamp is not None:
+            if state.get('embedding_stamp') is None:
+                print(f"WARNING: {path} has no stamp and can't be checked against the embeddings; "
+                      f"rebuild it with `python main.py --stage index`.")
+            else:
+                mismatch = embedding_stamp_mismatch(state['embedding_stamp'], embedding_stamp)
+                if mismatch is not None:
+                    raise ValueError(f"IVF index {mismatch}. Rebuild it with `python main.py --stage index`.")
+        return cls(song_embeddings, state['centroids'], state['list_offsets'], state['list_ids'], nprobe=nprobe)
+
+    def search(self, queries, k, seen_rows=None, seen_cols=None):
+        """Same contract as ExactIndex.search. Rows with fewer than ``k`` unseen
+        candidates are padded with index -1 and score -inf."""
+        nprobe = min(self.nprobe, self.num_lists)
+        with STAGE_SECONDS.time(stage='ivf_probe'):
+            _, probes = torch.topk(queries @ self.centroids.T, k=nprobe, dim=1)
+
+        out_scores = torch.full((queries.shape[0], k), -torch.inf, device=queries.device)
+        out_indices = torch.full((queries.shape[0], k), -1, dtype=torch.long, device=queries.device)
+        # Per-row scoring, masking and top-k are recorded together as one stage
+        with STAGE_SECONDS.time(stage='ivf_scan'):
+            self._scan(queries, k, probes, seen_rows, seen_cols, out_scores, out_indices)
+        return out_scores, out_indices
+
+    def _scan(self, queries, k, probes, seen_rows, seen_cols, out_scores, out_indices):
+        for row in range(queries.shape[0]):
+            candidates = torch.cat([
+                self.list_ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probes[row].tolist()
+            ])
+            scores = self.song_embeddings[candidates] @ queries[row]
+            if seen_rows is not None:
+                scores[torch.isin(candidates, seen_cols[seen_rows == row])] = -torch.inf
+
+            row_k = min(k, candidates.shape[0])
+            row_scores, order = torch.topk(scores, k=row_k)
+            row_indices = torch.where(row_scores > -torch.inf, candidates[order], -1)
+            out_scores[row, :row_k] = row_scores
+            out_indices[row, :row_k] = row_indices
+
+
+def evaluate_recall(index, reference_index, queries, k, seen_rows=None, seen_cols=None):
+    """Returns mean recall@k of ``index`` against ``reference_index`` (usually ExactIndex)
+    and the wall-clock seconds each took, over the same queries."""
+    start = time.perf_counter()
+    _, approx = index.search(queries, k, seen_rows, seen_cols)
+    approx_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, exact = reference_index.search(queries, k, seen_rows, seen_cols)
+    exact_seconds = time.perf_counter() - start
+
+    hits = sum(torch.isin(approx[row], exact[row]).sum().item() for row in range(queries.shape[0]))
+    recall = hits / (queries.shape[0] * exact.shape[1])
+    return recall, approx_seconds, exact_seconds
+
+
+def single_query_seconds(index, queries, k, seen_rows=None, seen_cols=None, num_queries=100):
+    """Returns the mean seconds of one-playlist searches (the per-request API path)
+    over the first ``num_queries`` queries."""
+    num_queries = min(num_queries, queries.shape[0])
+    start = time.perf_counter()
+    for row in range(num_queries):
+        row_cols = seen_cols[seen_rows == row] if seen_rows is not None else None
+        row_rows = torch.zeros_like(row_cols) if row_cols is not None else None
+        index.search(queries[row:row + 1], k, row_rows, row_cols)
+    return (time.perf_counter() - start) / max(num_queries, 1)
+
+
+def _sample_eval_queries(recommender, num_queries, seed=0):
+    """Returns (queries, seen_rows, seen_cols) for a random sample of playlists."""
+    num_playlists = recommender.final_embeddings['playlist'].shape[0]
+    sample = torch.randperm(num_playlists, generator=torch.Generator().manual_seed(seed))[:num_queries]
+    queries = recommender.final_embeddings['playlist'][sample.to(recommender.device)]
+    seen_rows, seen_cols = recommender.playlist_index.seen_pairs(sample.numpy())
+    return (queries, torch.from_numpy(seen_rows).to(recommender.device),
+            torch.from_numpy(seen_cols).to(recommender.device))
+
+
+def build_ivf_index(artifact_dir='artifacts', num_lists=None, nprobe_values=(1, 2, 4, 8, 16, 32),
+                    num_eval_queries=1000, k=10):
+    """Builds the IVF index from the recommender's song embeddings, saves it, and
+    reports recall@k against exact search for a range of ``nprobe`` settings."""
+    from .inference import Recommender  # Imported here to avoid a circular import
+
+    recommender = Recommender(artifact_dir=artifact_dir)
+    song_embeddings = recommender.final_embeddings['song']
+
+    print("Building IVF index over song embeddings...")
+    start = time.perf_counter()
+    index = IVFIndex.build(song_embeddings, num_lists=num_lists)
+    print(f"Built {index.num_lists} lists in {time.perf_counter() - start:.1f}s.")
+    index.save(os.path.join(artifact_dir, IVF_INDEX_FILE), embedding_stamp=recommender.embedding_stamp)
+
+    # --- Recall vs exact search on a sample of playlists ---
+    queries, seen_rows, seen_cols = _sample_eval_queries(recommender, num_eval_queries)
+    exact = ExactIndex(song_embeddings)
+    print(f"\n--- Recall@{k} vs exact search ({queries.shape[0]} playlists) ---")
+    for nprobe in nprobe_values:
+        index.nprobe = nprobe
+        recall, approx_seconds, exact_seconds = evaluate_recall(index, exact, queries, k, seen_rows, seen_cols)
+        print(f"nprobe={nprobe:3d}  recall={recall:.4f}  ivf={approx_seconds:.3f}s  exact={exact_seconds:.3f}s")
+    print(f"\nIVF index saved to {os.path.join(artifact_dir, IVF_INDEX_FILE)}.")
+
+
+def build_quantized_index(artifact_dir='artifacts', dtypes=('int8', 'float16'), rerank_factors=(1, 2, 4, 8),
+                          num_eval_queries=1000, k=10):
+    """Writes quantized copies of the song embeddings and reports recall@k and
+    latency against float32 exact search for a range of re-rank factors."""
+    from .inference import Recommender  # Imported here to avoid a circular import
+
+    # Quantize the export that the API memory-maps, never embeddings from a graph forward pass
+    recommender = Recommender(artifact_dir=artifact_dir, mode='embeddings')
+    song_embeddings = recommender.final_embeddings['song']
+    queries, seen_rows, seen_cols = _sample_eval_queries(recommender, num_eval_queries)
+    exact = ExactIndex(song_embeddings)
+    float32_mb = song_embeddings.numel() * 4 / 1e6
+
+    for dtype in dtypes:
+        codes, scales = quantize_embeddings(song_embeddings, dtype)
+        index = QuantizedIndex(song_embeddings, codes, scales)
+        index.save(artifact_dir, dtype, embedding_stamp=recommender.embedding_stamp)
+        quantized_mb = (codes.numel() * codes.element_size() + (scales.numel() * 4 if scales is not None else 0)) / 1e6
+        print(f"\n--- {dtype}: {quantized_mb:.1f} MB vs {float32_mb:.1f} MB float32; "
+              f"recall@{k} vs float32 exact search ({queries.shape[0]} playlists) ---")
+        for rerank_factor in rerank_factors:
+            index.rerank_factor = rerank_factor
+            recall, approx_seconds, exact_seconds = evaluate_recall(index, exact, queries, k, seen_rows, seen_cols)
+            single_ms = single_query_seconds(index, queries, k, seen_rows, seen_cols) * 1000
+            exact_single_ms = single_query_seconds(exact, queries, k, seen_rows, seen_cols) * 1000
+            print(f"rerank_factor={rerank_factor:2d}  recall={recall:.4f}  "
+                  f"batch: {dtype}={approx_seconds:.3f}s float32={exact_seconds:.3f}s  "
+                  f"single query: {dtype}={single_ms:.2f}ms float32={exact_single_ms:.2f}ms")
+        print(f"Saved to {os.path.join(artifact_dir, QUANTIZED_EMBEDDING_FILES[dtype])}.")
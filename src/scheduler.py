@@ -0,0 +1,158 @@
+# src/scheduler.py
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import torch
+
+from .metrics import PROFILER
+
+class _Request:
+    __slots__ = ('playlist_idx', 'k', 'future', 'profiled_request')
+
+    def __init__(self, playlist_idx, k):
+        self.playlist_idx = playlist_idx
+        self.k = k
+        self.future = Future()
+        # Captured at submit, in the caller's context, since the work runs in a worker thread
+        self.profiled_request = PROFILER.current_request()
+
+class _BulkRequest:
+    __slots__ = ('playlist_indices', 'k', 'future', 'profiled_request')
+
+    def __init__(self, playlist_indices, k):
+        self.playlist_indices = playlist_indices
+        self.k = k
+        self.future = Future()
+        self.profiled_request = PROFILER.current_request()
+
+class InferenceScheduler:
+    """Collects concurrent ranking requests and scores them together.
+
+    Each worker thread takes the first queued request, then keeps collecting
+    for up to ``max_wait_ms`` (or until ``max_batch_size`` requests) and ranks
+    the whole batch with one ``Recommender.top_k_songs`` call. Async callers
+    await the result without blocking the event loop. Bulk jobs (``submit_many``)
+    are scored on their own, in the recommender's large blocks.
+
+    ``torch_threads`` sets torch's intra-op thread count for the process; keep
+    ``num_workers * torch_threads`` at or below the available cores so workers
+    don't oversubscribe the CPU.
+    """
+    def __init__(self, recommender, max_batch_size=64, max_wait_ms=2.0, num_workers=1, torch_threads=None):
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        self.recommender = recommender
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._closed = False
+        self._workers = [
+            threading.Thread(target=self._run, name=f'inference-worker-{i}', daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, playlist_idx, k):
+        """Queues one playlist index and returns a Future of its ranked song indices."""
+        if self._closed:
+            raise RuntimeError("InferenceScheduler is closed.")
+        request = _Request(playlist_idx, k)
+        self._queue.put(request)
+        return request.future
+
+    def submit_many(self, playlist_indices, k):
+        """Queues many playlist indices as one job and returns a Future of their
+        [len(playlist_indices), k] song-index array (rows may be padded with -1)."""
+        if self._closed:
+            raise RuntimeError("InferenceScheduler is closed.")
+        request = _BulkRequest(playlist_indices, k)
+        self._queue.put(request)
+        return request.future
+
+    async def rank_songs(self, playlist_id, num_recommendations=10):
+        """Async counterpart of Recommender.rank_songs, served through the batching queue."""
+        playlist_idx = self.recommender.playlist_mapping.get(playlist_id)
+        if playlist_idx is None:
+            return None
+        return await asyncio.wrap_future(self.submit(playlist_idx, num_recommendations))
+
+    async def rank_songs_batch(self, playlist_ids, num_recommendations=10):
+        """Ranks many playlist IDs as one bulk job; returns ranked song indices per ID,
+        in input order, with None for unknown IDs."""
+        lookup = self.recommender.playlist_mapping.lookup(playlist_ids)
+        known = (lookup >= 0).nonzero()[0]
+        results = [None] * len(playlist_ids)
+        if len(known):
+            top_k = await asyncio.wrap_future(self.submit_many(lookup[known], num_recommendations))
+            for pos, row in zip(known, top_k):
+                results[pos] = row[row >= 0]
+        return results
+
+    def close(self):
+        """Stops the workers after the requests already queued are served."""
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            if isinstance(first, _BulkRequest):
+                self._process_bulk(first)
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait_seconds
+            stop = False
+            bulk = None
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                if isinstance(request, _BulkRequest):
+                    # Served right after the batch collected so far
+                    bulk = request
+                    break
+                batch.append(request)
+
+            self._process(batch)
+            if bulk is not None:
+                self._process_bulk(bulk)
+            if stop:
+                return
+
+    def _process(self, batch):
+        try:
+            k = max(request.k for request in batch)
+            with PROFILER.profile([request.profiled_request for request in batch], batch_size=len(batch)):
+                top_k = self.recommender.top_k_songs([request.playlist_idx for request in batch], k).cpu().numpy()
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        for request, row in zip(batch, top_k):
+            request.future.set_result(row[row >= 0][:request.k])
+
+    def _process_bulk(self, request):
+        try:
+            with PROFILER.profile([request.profiled_request], batch_size=len(request.playlist_indices)):
+                top_k = self.recommender.top_k_songs(request.playlist_indices, request.k).cpu().numpy()
+        except Exception as e:
+            request.future.set_exception(e)
+            return
+        request.future.set_result(top_k)
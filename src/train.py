@@ -1,78 +1,361 @@
 # src/train.py
+import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn.functional as F
 import torch_geometric.transforms as T
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from torch_geometric.loader import LinkNeighborLoader
+from torch_geometric.sampler import NeighborSampler
+from torch_geometric.typing import WITH_PYG_LIB, WITH_TORCH_SPARSE
 from sklearn.metrics import roc_auc_score
+import socket
 import time
 import os
 
-from model import Model # Import the model class
+from .artifacts import HOLDOUT_EDGES_FILE
+from .model import Model # Import the model class
 
-def train_model(data_path, epochs=300, hidden_channels=64, lr=0.01, output_dir='artifacts'):
-    """Loads graph data, trains the GNN model, and saves the weights."""
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"Using device: {device}")
+EDGE_TYPE = ('song', 'belongs_to', 'playlist')
+REV_EDGE_TYPE = ('playlist', 'contains', 'song')
+CHECKPOINT_FILE = 'training_checkpoint.pt'
 
+def build_neighbor_samplers(splits, num_neighbors, share_memory=False):
+    """Returns one NeighborSampler per split, reusing it for splits with the same message-passing graph.
+
+    Each sampler holds a sorted CSC copy of its graph's adjacency. Built once in
+    the parent with ``share_memory``, those copies are shared by all training
+    processes instead of every rank building its own.
+    """
+    samplers = []
+    for i, split in enumerate(splits):
+        sampler = next((samplers[j] for j in range(i)
+                        if torch.equal(splits[j][EDGE_TYPE].edge_index, split[EDGE_TYPE].edge_index)), None)
+        if sampler is None:
+            sampler = NeighborSampler(split, num_neighbors=list(num_neighbors), share_memory=share_memory)
+        samplers.append(sampler)
+    return samplers
+
+def make_link_loader(data_split, num_neighbors, batch_size, shuffle, num_workers=0, edge_ids=None,
+                     neighbor_sampler=None, sampler=None):
+    """Builds a link-level neighbour-sampling loader over a split's supervision edges.
+
+    ``edge_ids`` restricts the loader to those supervision edges (one rank's
+    fixed shard), and ``sampler`` (e.g. a DistributedSampler) picks and orders
+    them instead of ``shuffle``; neighbours are still sampled from the whole
+    graph, with ``neighbor_sampler`` if given.
+    """
+    edge_label_index = data_split[EDGE_TYPE].edge_label_index
+    edge_label = data_split[EDGE_TYPE].edge_label
+    if edge_ids is not None:
+        edge_label_index, edge_label = edge_label_index[:, edge_ids], edge_label[edge_ids]
+    return LinkNeighborLoader(
+        data=data_split,
+        num_neighbors=list(num_neighbors),
+        edge_label_index=(EDGE_TYPE, edge_label_index),
+        edge_label=edge_label,
+        batch_size=batch_size,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        neighbor_sampler=neighbor_sampler,
+    )
+
+def shard_edges(num_edges, rank, world_size, seed, equal=True):
+    """Returns the positions of the supervision edges assigned to ``rank``.
+
+    With ``equal`` every rank gets the same number of edges (up to
+    ``world_size - 1`` are dropped), so all ranks run the same number of
+    batches and their gradient all-reduces line up.
+    """
+    perm = torch.randperm(num_edges, generator=torch.Generator().manual_seed(seed))
+    if equal:
+        perm = perm[:num_edges - num_edges % world_size]
+    return perm[rank::world_size]
+
+def save_checkpoint(path, state):
+    """Writes a checkpoint atomically, so a crash mid-write never corrupts the last good one."""
+    tmp_path = f'{path}.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+def prepare_splits(data_path, seed=0):
+    """Loads the graph and splits its edges into train/val/test.
+
+    The split is seeded so that every process, and a resumed run, sees the same edges.
+    """
     data = torch.load(data_path, weights_only=False)
     data['playlist'].node_id = torch.arange(data['playlist'].num_nodes)
-    
-    transform = T.RandomLinkSplit(...) # Same as in notebook
-    train_data, val_data, test_data = transform(data)
-    train_data, val_data, test_data = train_data.to(device), val_data.to(device), test_data.to(device)
+
+    torch.manual_seed(seed)
+    transform = T.RandomLinkSplit(
+        num_val=0.1, num_test=0.1, is_undirected=True,
+        add_negative_train_samples=True,
+        edge_types=[EDGE_TYPE],
+        rev_edge_types=[REV_EDGE_TYPE]
+    ) # Same as in notebook
+    return transform(data)
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def train_model(data_path, epochs=300, hidden_channels=64, lr=0.01, output_dir='artifacts',
+                batch_size=None, num_neighbors=(20, 10), num_workers=0, nproc=1, seed=0, resume=False,
+                eval_interval=5, patience=10, checkpoint_interval=10):
+    """Loads graph data, trains the GNN model, and saves the weights.
+
+    With ``batch_size`` unset every epoch is one full-graph step. Otherwise the
+    supervision edges are split into mini-batches and each batch only sees the
+    ``num_neighbors`` (one fanout per GNN layer) sampled neighbourhood of its
+    endpoints, so peak memory depends on batch size and fanout, not graph size.
+    Validation/test AUC are then also computed batch by batch.
+
+    ``nproc > 1`` trains with DistributedDataParallel on CPU (gloo backend):
+    each process takes an equal shard of the mini-batches, gradients are
+    averaged across processes, and the graph and the neighbour samplers' CSC
+    adjacency are built once and shared between them through shared memory
+    rather than copied. The training edges are re-sharded across processes
+    every epoch.
+
+    Validation AUC is computed every ``eval_interval`` epochs and training stops
+    once it has not improved for ``patience`` evaluations (None disables early
+    stopping); the saved weights are those of the best evaluation, and test
+    AUC is reported once for them at the end. Model, optimizer and
+    early-stopping state are checkpointed (from rank 0) every
+    ``checkpoint_interval`` epochs and when training ends, and ``resume``
+    continues from that checkpoint.
+    """
+    if nproc > 1 and batch_size is None:
+        raise ValueError("Distributed training splits mini-batches across processes; set batch_size as well.")
+    if batch_size is not None and not (WITH_PYG_LIB or WITH_TORCH_SPARSE):
+        # Checked up front; LinkNeighborLoader would only fail at the first batch
+        raise ImportError("Mini-batch training samples neighbours with pyg-lib or torch-sparse, and neither "
+                          "is installed. Install pyg-lib for your torch version (see requirements-train.txt).")
+
+    splits = prepare_splits(data_path, seed)
+    config = dict(
+        epochs=epochs, hidden_channels=hidden_channels, lr=lr, output_dir=output_dir,
+        batch_size=batch_size, num_neighbors=num_neighbors, num_workers=num_workers,
+        seed=seed, resume=resume, eval_interval=eval_interval, patience=patience,
+        checkpoint_interval=checkpoint_interval, threads_per_rank=max(1, (os.cpu_count() or 1) // nproc),
+    )
+    samplers = None
+    if batch_size is not None:
+        samplers = build_neighbor_samplers(splits, num_neighbors, share_memory=nproc > 1)
+    if nproc == 1:
+        _fit(0, 1, splits, config, samplers)
+        return
+
+    # Workers receive handles to these tensors (and the samplers' CSC copies) instead of pickled copies
+    for split in splits:
+        split.share_memory_()
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(_free_port()))
+    print(f"Starting {nproc} training processes ({config['threads_per_rank']} threads each)...")
+    mp.spawn(_fit, args=(nproc, splits, config, samplers), nprocs=nproc, join=True)
+
+def _fit(rank, world_size, splits, config, samplers=None):
+    """Training loop of one process; ``world_size == 1`` is plain single-process training."""
+    distributed = world_size > 1
+    is_main = rank == 0
+    log = print if is_main else (lambda *args, **kwargs: None)
+    if distributed:
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+        torch.set_num_threads(config['threads_per_rank'])
+        device = torch.device('cpu')
+    else:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    log(f"Using device: {device}")
+
+    train_data, val_data, test_data = splits
+    batch_size, num_neighbors, num_workers = config['batch_size'], config['num_neighbors'], config['num_workers']
+    mini_batch = batch_size is not None
+    train_sampler = None
+    if mini_batch:
+        # Splits stay on the CPU; only sampled subgraphs are moved to the device
+        def eval_loader(data_split, neighbor_sampler):
+            edge_ids = None
+            if distributed:
+                num_edges = data_split[EDGE_TYPE].edge_label.numel()
+                edge_ids = shard_edges(num_edges, rank, world_size, config['seed'], equal=False)
+            return make_link_loader(data_split, num_neighbors, batch_size, shuffle=False,
+                                    num_workers=num_workers, edge_ids=edge_ids, neighbor_sampler=neighbor_sampler)
+
+        if samplers is None:
+            samplers = build_neighbor_samplers(splits, num_neighbors)
+        torch.manual_seed(config['seed'] + rank)  # Different batch order per rank
+        if distributed:
+            # Equal shards of the training edges, reshuffled across ranks every epoch via set_epoch
+            train_sampler = DistributedSampler(range(train_data[EDGE_TYPE].edge_label.numel()),
+                                               num_replicas=world_size, rank=rank, shuffle=True,
+                                               seed=config['seed'], drop_last=True)
+        train_loader = make_link_loader(train_data, num_neighbors, batch_size, shuffle=True,
+                                        num_workers=num_workers, neighbor_sampler=samplers[0],
+                                        sampler=train_sampler)
+        val_loader = eval_loader(val_data, samplers[1])
+        test_loader = eval_loader(test_data, samplers[2])
+        log(f"Mini-batch training: batch_size={batch_size}, num_neighbors={list(num_neighbors)}, "
+            f"{len(train_loader)} batches per epoch" + (f" per process ({world_size} processes)." if distributed else "."))
+    else:
+        train_data, val_data, test_data = train_data.to(device), val_data.to(device), test_data.to(device)
 
     model = Model(
-        hidden_channels=hidden_channels, 
-        num_playlists=data['playlist'].num_nodes,
-        num_song_features=data['song'].x.shape[1]
+        hidden_channels=config['hidden_channels'],
+        num_playlists=train_data['playlist'].num_nodes,
+        num_song_features=train_data['song'].x.shape[1]
     ).to(device)
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'])
+
+    # --- Resume from the last checkpoint ---
+    output_dir = config['output_dir']
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    start_epoch = 1
+    best = {'val_auc': None, 'epoch': None, 'state': None, 'evals_since': 0}
+    if config['resume']:
+        if os.path.exists(checkpoint_path):
+            checkpoint = load_checkpoint(checkpoint_path)
+            if checkpoint['seed'] != config['seed']:
+                raise ValueError(f"Checkpoint was trained with seed {checkpoint['seed']}, not {config['seed']}; "
+                                 "the edge split would differ.")
+            model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            start_epoch = checkpoint['epoch'] + 1
+            best = checkpoint.get('best', best)
+            log(f"Resumed from {checkpoint_path} after epoch {checkpoint['epoch']}.")
+        else:
+            log(f"No checkpoint at {checkpoint_path}; starting from scratch.")
+
+    # Gradients are all-reduced across processes on backward
+    ddp_model = DistributedDataParallel(model) if distributed else model
 
-    # --- 5. Train and Test Functions (no changes needed) ---
-    def train():
-        model.train()
+    # --- 5. Train and Test Functions ---
+    def train_step(batch):
+        ddp_model.train()
         optimizer.zero_grad()
-        embeddings = model(train_data)
-        
-        edge_label_index = train_data['song', 'belongs_to', 'playlist'].edge_label_index
-        edge_label = train_data['song', 'belongs_to', 'playlist'].edge_label
-        
+        embeddings = ddp_model(batch)
+
+        edge_label_index = batch[EDGE_TYPE].edge_label_index
+        edge_label = batch[EDGE_TYPE].edge_label
+
         pred = model.decode(
             embeddings['song'][edge_label_index[0]],
             embeddings['playlist'][edge_label_index[1]]
         )
-        
+
         loss = F.binary_cross_entropy_with_logits(pred, edge_label)
         loss.backward()
         optimizer.step()
-        return loss
+        return float(loss)
+
+    def train(epoch):
+        if not mini_batch:
+            return train_step(train_data)
+
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        total_loss = total_examples = 0
+        for batch in train_loader:
+            batch = batch.to(device)
+            num_examples = batch[EDGE_TYPE].edge_label.numel()
+            total_loss += train_step(batch) * num_examples
+            total_examples += num_examples
+        if distributed:
+            totals = torch.tensor([total_loss, total_examples], dtype=torch.float64)
+            dist.all_reduce(totals)
+            total_loss, total_examples = totals.tolist()
+        return total_loss / total_examples
 
     @torch.no_grad()
-    def test(data_split):
-        model.eval()
-        embeddings = model(data_split)
-        
-        edge_label_index = data_split['song', 'belongs_to', 'playlist'].edge_label_index
-        edge_label = data_split['song', 'belongs_to', 'playlist'].edge_label
-        
+    def predict(batch):
+        embeddings = model(batch)
+
+        edge_label_index = batch[EDGE_TYPE].edge_label_index
         pred = model.decode(
             embeddings['song'][edge_label_index[0]],
             embeddings['playlist'][edge_label_index[1]]
         ).sigmoid()
-        
+
         # Move predictions and labels to CPU for scikit-learn
-        return roc_auc_score(edge_label.cpu().numpy(), pred.cpu().numpy())
-    
-    print(f"\nStarting training for {epochs} epochs...")
-    for epoch in range(1, epochs + 1):
-        loss = train(model, optimizer, train_data)
-        val_auc = test(model, val_data)
-        test_auc = test(model, test_data)
-        print(f'Epoch: {epoch:03d}, Loss: {loss:.4f}, Val AUC: {val_auc:.4f}, Test AUC: {test_auc:.4f}')
-
-    print("\nTraining complete!")
-    torch.save(model.state_dict(), os.path.join(output_dir, 'trained_model_weights_gpu.pt'))
-    print("Trained model weights saved.")
+        return pred.cpu(), batch[EDGE_TYPE].edge_label.cpu()
+
+    @torch.no_grad()
+    def test(data_split, loader):
+        model.eval()
+        if not mini_batch:
+            preds, labels = predict(data_split)
+        else:
+            outputs = [predict(batch.to(device)) for batch in loader]
+            if distributed:
+                # Each rank scored its shard; every rank computes the AUC over all of them
+                gathered = [None] * world_size
+                dist.all_gather_object(gathered, outputs)
+                outputs = [output for rank_outputs in gathered for output in rank_outputs]
+            preds = torch.cat([pred for pred, _ in outputs])
+            labels = torch.cat([label for _, label in outputs])
+        return roc_auc_score(labels.numpy(), preds.numpy())
+
+    def checkpoint(epoch):
+        if is_main:
+            save_checkpoint(checkpoint_path, {
+                'epoch': epoch,
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'seed': config['seed'],
+                'best': best,
+            })
+
+    epochs, eval_interval, patience = config['epochs'], config['eval_interval'], config['patience']
+    log(f"\nStarting training for epochs {start_epoch}-{epochs}...")
+    epoch = start_epoch - 1
+    for epoch in range(start_epoch, epochs + 1):
+        start = time.time()
+        loss = train(epoch)
+        message = f'Epoch: {epoch:03d}, Loss: {loss:.4f}'
+
+        stop = False
+        if epoch % eval_interval == 0 or epoch == epochs:
+            val_auc = test(val_data, val_loader if mini_batch else None)
+            message += f', Val AUC: {val_auc:.4f}'
+            if best['val_auc'] is None or val_auc > best['val_auc']:
+                state = {key: value.detach().cpu().clone() for key, value in model.state_dict().items()}
+                best = {'val_auc': val_auc, 'epoch': epoch, 'state': state, 'evals_since': 0}
+            else:
+                best['evals_since'] += 1
+                # Every rank sees the same AUC, so all of them stop at the same epoch
+                stop = patience is not None and best['evals_since'] >= patience
+        log(f'{message}, Time: {time.time() - start:.1f}s')
+
+        if stop or epoch % config['checkpoint_interval'] == 0:
+            checkpoint(epoch)
+        if stop:
+            log(f"Early stopping: validation AUC has not improved for {patience} evaluations.")
+            break
+    else:
+        checkpoint(epoch)
+
+    log(f"\nTraining complete after {epoch} epochs!")
+    if best['state'] is not None:
+        model.load_state_dict(best['state'])
+        log(f"Using the weights of epoch {best['epoch']} (Val AUC: {best['val_auc']:.4f}).")
+    test_auc = test(test_data, test_loader if mini_batch else None)
+    log(f"Test AUC: {test_auc:.4f}")
+    if is_main:
+        torch.save(model.state_dict(), os.path.join(output_dir, 'trained_model_weights_gpu.pt'))
+        # The test positives were never trained on nor message-passed over; offline evaluation hides these
+        test_edges = test_data[EDGE_TYPE].edge_label_index[:, test_data[EDGE_TYPE].edge_label == 1]
+        np.save(os.path.join(output_dir, HOLDOUT_EDGES_FILE), test_edges.cpu().numpy().astype(np.int64))
+        print("Trained model weights saved.")
+    if distributed:
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     graph_path = 'artifacts/graph_data.pt'
-    train_model(graph_path)
\ No newline at end of file
+    train_model(graph_path)